@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# Playlist filter benchmark: filters a synthetic queue with song by song
+# regex matching, the column scan of the song store and (if numpy is
+# installed) the numpy scan, and prints the time each of them takes.
+#
+# Usage: python bench/filter.py [QUEUE]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from library import library, queue
+
+import wrapper
+from query import Query, scan
+from status import Playlist
+from wrapper import MPDWrapper
+
+QUERIES = ["artist 1", "track 12", "album 3 artist", "tr.ck 12", "^Track"]
+
+
+def timed(f, *args):
+    t = time.time()
+    v = f(*args)
+    return v, (time.time() - t) * 1000
+
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 100000
+
+    mpd = MPDWrapper("localhost", 6600)  # Not connected, just the store
+    playlist = Playlist(mpd)
+    playlist.init(queue(library(n), n), 1)
+    songs = playlist.real_items
+    np = wrapper.numpy
+
+    print "%i queued, times in ms%s" % (n, "" if np else " (no numpy)")
+    if np:  # Done once per change to the store, not per search
+        print "packing columns: %.0f" % timed(mpd.songs._pack)[1]
+    print "%-16s %8s %8s %8s %8s" % ("query", "matches", "per-song",
+            "columns", "numpy")
+    for s in QUERIES:
+        q = Query(s)
+        matched, per_song = timed(scan, q, songs)
+        wrapper.numpy = None
+        columns = timed(mpd.songs.scan, q, songs)[1]
+        wrapper.numpy = np
+        vectorised = "%.0f" % timed(mpd.songs.scan, q, songs)[1] if np else "-"
+        print "%-16s %8i %8.0f %8.0f %8s" % (s, len(matched), per_song,
+                columns, vectorised)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,70 @@
+# -*- encoding: utf-8 -*-
+
+# Synthetic MPD libraries for the benchmarks: listallinfo-style entries laid
+# out as artist/album/track, with tag values repeated the way they are in
+# real collections. Every entry gets its own string objects, like the ones
+# python-mpd hands out.
+
+import random
+
+GENRES = [u"Rock", u"Jazz", u"Electronic", u"Classical", u"Hip-Hop", u"Folk",
+        u"Metal", u"Pop", u"Soundtrack", u"Blues"]
+
+# Words used instead of Artist/Album/Track for unicode libraries
+UNICODE_WORDS = [(u"Künstler", u"Album", u"Stück"),
+        (u"Исполнитель", u"Альбом", u"Трек"),
+        (u"アーティスト", u"アルバム", u"トラック"),
+        (u"Καλλιτέχνης", u"Άλμπουμ", u"Κομμάτι")]
+
+
+def library(songs, tracks=12, albums=4, seed=1, depth=0, fanout=4,
+        unicode_tags=False):
+    """Returns the listallinfo entries (directories first in each directory)
+    of a library with the given number of songs. The artist directories are
+    depth levels down a tree of fanout directories per level, and tags and
+    names are in several scripts if unicode_tags is set."""
+    rnd = random.Random(seed)
+    entries = []
+    seen = set()
+    n = 0
+    artist = 0
+    while n < songs:
+        words = (u"Artist", u"Album", u"Track")
+        if unicode_tags:
+            words = UNICODE_WORDS[artist % len(UNICODE_WORDS)]
+        parent = u""
+        for level in xrange(depth):
+            parent += u"Level %i-%i/" % (level,
+                    artist / fanout ** (depth - level) % fanout)
+            if not parent in seen:
+                seen.add(parent)
+                entries.append({"directory": parent[:-1]})
+        adir = u"%s%s %i" % (parent, words[0], artist)
+        entries.append({"directory": adir})
+        for album in xrange(albums):
+            if n >= songs:
+                break
+            bdir = u"%s/%s %i" % (adir, words[1], album)
+            genre = GENRES[rnd.randrange(len(GENRES))]
+            entries.append({"directory": bdir})
+            for track in xrange(min(tracks, songs - n)):
+                entries.append({"file": u"%s/%02i - %s %i.flac" % (bdir,
+                    track + 1, words[2], n),
+                    "artist": u"%s %i" % (words[0], artist),
+                    "album": u"%s %i of %s %i" % (words[1], album,
+                        words[0].lower(), artist),
+                    "title": u"%s %i" % (words[2], n),
+                    "genre": u"%s" % genre,
+                    "time": str(rnd.randrange(90, 600))})
+                n += 1
+        artist += 1
+    return entries
+
+
+def queue(entries, songs, seed=1):
+    """Returns plchanges-style entries for a queue of songs picked from
+    the library entries."""
+    rnd = random.Random(seed)
+    files = [v for v in entries if "file" in v]
+    return [dict(rnd.choice(files), pos=str(i), id=str(i + 1))
+            for i in xrange(songs)]
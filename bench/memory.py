@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# Memory held by the song store, the browser tree and the playlist for a
+# synthetic library, counted object by object (each object is only counted
+# for the first of them that refers to it).
+#
+# Usage: python bench/memory.py [SONGS [QUEUE]]
+
+import gc
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from library import library, queue
+
+import browser
+from status import Playlist
+from wrapper import MPDWrapper
+
+
+def size(root, seen):
+    """Returns the size of everything reachable from root that isn't in
+    seen yet (classes, functions and modules excluded)."""
+    total = 0
+    stack = [root]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, (type, types.ClassType,
+                types.ModuleType, types.FunctionType, types.MethodType)):
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        stack.extend(gc.get_referents(o))
+    return total
+
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 500000
+    q = int(argv[2]) if len(argv) > 2 else 100000
+
+    entries = library(n)
+    mpd = MPDWrapper("localhost", 6600)  # Not connected, just the store
+    tree = browser.DirectoryNode(mpd, browser.Path(), None)
+    tree.ingest(entries)
+    playlist = Playlist(mpd)
+    playlist.init(queue(entries, q), 1)
+    del entries
+
+    seen = set([id(mpd)])
+    mb = 1024.0 * 1024.0
+    print "%i songs, %i queued" % (n, q)
+    print "songs:    %7.1f MB" % (size(mpd.songs, seen) / mb)
+    print "tree:     %7.1f MB" % (size(tree, seen) / mb)
+    print "playlist: %7.1f MB" % (size(playlist.real_items, seen) / mb)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# Full-screen playlist redraw benchmark. Draws into an in-memory back buffer
+# instead of a terminal, once through change_cell() only and once through a
+# bulk change_cells() call, and prints frames per second for both.
+#
+# Usage: python bench/render.py [WIDTH HEIGHT [SONGS [FRAMES]]]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from browser import Browser
+from common import Message
+from main import UI
+from status import Status
+from wrapper import SongStore
+
+
+class FakeTermbox(object):
+
+    def __init__(self, w, h):
+        self.w, self.h = w, h
+        self.clear()
+
+    def width(self):
+        return self.w
+
+    def height(self):
+        return self.h
+
+    def clear(self):
+        self.buffer = [[(32, 0, 0)] * self.w for y in xrange(self.h)]
+
+    def change_cell(self, x, y, c, fg, bg):
+        if 0 <= x < self.w and 0 <= y < self.h:
+            self.buffer[y][x] = (c, fg, bg)
+
+    def present(self):
+        pass
+
+
+class BulkTermbox(FakeTermbox):
+
+    def change_cells(self, x, y, s, fg, bg):
+        if 0 <= y < self.h:
+            row = self.buffer[y]
+            row[x:x + len(s)] = [(ord(c), fg, bg) for c in s]
+
+
+class FakeMPD(object):
+
+    connected = False
+
+    def __init__(self):
+        self.songs = SongStore()
+
+
+def playlist(n):
+    return [{"file": u"artist %i/album/%i.mp3" % (i / 100, i),
+        "artist": u"Artist %i" % (i / 100), "album": u"Album %i" % (i / 10),
+        "title": u"Title %i" % i, "time": str(180 + i % 120),
+        "id": str(i), "pos": str(i)} for i in xrange(n)]
+
+
+def run(tb, songs, frames):
+    msg = Message()
+    status = Status(FakeMPD(), msg)
+    ui = UI(tb, status, msg, Browser(FakeMPD()))
+    status.playlist.init(songs, 1)
+    ui.set_main(ui.playlist)
+    ui.show_top(ui.playlist_bar)
+    ui.draw()
+
+    t = time.time()
+    for i in xrange(frames):
+        ui.invalidate()
+        ui.draw()
+    return frames / (time.time() - t), tb.buffer
+
+
+def main(argv):
+    args = [int(v) for v in argv[1:]] + [200, 60, 10000, 200][len(argv) - 1:]
+    w, h, n, frames = args[:4]
+
+    songs = playlist(n)
+    fps, buf = run(FakeTermbox(w, h), songs, frames)
+    bulk_fps, bulk_buf = run(BulkTermbox(w, h), songs, frames)
+    assert buf == bulk_buf
+
+    print "%ix%i, %i songs, %i full redraws" % (w, h, n, frames)
+    print "change_cell:  %8.1f frames/s" % fps
+    print "change_cells: %8.1f frames/s" % bulk_fps
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,359 @@
+# -*- encoding: utf-8 -*-
+
+# An MPD stand-in for the benchmarks: serves a synthetic library (see
+# library.py) and a queue over the MPD protocol, from a thread of the
+# benchmark's own process. Covers the commands the client uses, keeps MPD's
+# plchanges and idle semantics and counts the commands (command lists) it
+# serves.
+
+import errno
+import fcntl
+import os
+import re
+import select
+import socket
+import threading
+
+_ARG = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+_TAGS = [("artist", "Artist"), ("album", "Album"), ("title", "Title"),
+        ("genre", "Genre"), ("time", "Time")]
+
+
+class Ack(Exception):
+
+    def __init__(self, code, cmd, text):
+        super(Ack, self).__init__("ACK [%i@0] {%s} %s" % (code, cmd, text))
+
+
+def _args(line):
+    """Splits a request into the command and its (unquoted) arguments."""
+    words = [q.replace('\\"', '"').replace("\\\\", "\\") if q or not w else w
+            for q, w in _ARG.findall(line)]
+    return words[0], [w.decode("utf-8") for w in words[1:]]
+
+
+def _range(arg, n):
+    """Returns the [start, end) of a "pos" or "start:end" argument."""
+    if arg == None:
+        return 0, n
+    start, sep, end = arg.partition(":")
+    if not sep:
+        return int(start), int(start) + 1
+    return int(start), min(int(end), n) if end else n
+
+
+def _tags(blob):
+    """Returns the lower-cased values of an entry's lines by key."""
+    lines = blob.decode("utf-8").lower().splitlines()
+    return dict(l.split(": ", 1) for l in lines)
+
+
+def _matches(tags, pairs):
+    """Tells if tags has all the (lower-cased) tag and substring pairs, as
+    MPD's playlistsearch (the tag "any" matching any value)."""
+    for tag, needle in pairs:
+        values = tags.values() if tag == "any" else [tags.get(tag, u"")]
+        if not any(needle in v for v in values):
+            return False
+    return True
+
+
+class _Client(object):
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = ""
+        self.events = set()
+        self.rfd, self.wfd = os.pipe()
+        fcntl.fcntl(self.wfd, fcntl.F_SETFL, os.O_NONBLOCK)
+
+    def wake(self):
+        try:
+            os.write(self.wfd, "x")
+        except OSError as e:  # Pipe full, already woken up
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def readline(self, idling=False):
+        """Returns the next request line (None at EOF). While idling, also
+        returns "" when woken up by an event."""
+        while not "\n" in self.buf:
+            fds = [self.sock, self.rfd] if idling else [self.sock]
+            readable = select.select(fds, [], [])[0]
+            if self.rfd in readable:
+                os.read(self.rfd, 4096)
+                if self.events:
+                    return ""
+            if self.sock in readable:
+                data = self.sock.recv(65536)
+                if not data:
+                    return None
+                self.buf += data
+        line, self.buf = self.buf.split("\n", 1)
+        return line
+
+
+class Server(object):
+    """Serves the listallinfo-style entries (directories first in each
+    directory) and the queue of files on a free port of 127.0.0.1."""
+
+    def __init__(self, entries, queue=(), latency=0):
+        self.latency = latency  # Seconds added to every round trip
+        self.lock = threading.Lock()
+        self.clients = []
+        self.roundtrips = 0  # Commands served, idle not counted
+        self.db_update = 1
+        self.blobs = []  # Entry index -> its lines, as sent
+        self.children = {u"": []}  # Directory -> entry indices
+        self.subtree = {u"": (0, len(entries))}  # Directory -> [start, end)
+        self.index = {}  # File -> entry index
+        self.tags = {}  # Entry index -> _tags() of it, once searched
+        self._add_library(entries)
+
+        self.version = 1
+        self.queue = []  # [entry index, song id, version]
+        self.next_id = 1
+        self.current = -1
+        self.state = "stop"
+        for f in queue:
+            self._append(self.index[f])
+
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self._thread(self._accept)
+
+    def _add_library(self, entries):
+        open_dirs = []
+        for i, v in enumerate(entries):
+            path = v.get("directory", v.get("file"))
+            while open_dirs and not path.startswith(open_dirs[-1][0] + "/"):
+                d, start = open_dirs.pop()
+                self.subtree[d] = (start, i)
+            self.children[open_dirs[-1][0] if open_dirs else u""].append(i)
+            if "directory" in v:
+                self.blobs.append(("directory: %s\n" % path).encode("utf-8"))
+                self.children[path] = []
+                open_dirs.append((path, i + 1))
+            else:
+                self.blobs.append(("file: %s\n" % path + "".join(
+                    "%s: %s\n" % (key, v[tag]) for tag, key in _TAGS
+                    if tag in v)).encode("utf-8"))
+                self.index[path] = i
+        for d, start in open_dirs:
+            self.subtree[d] = (start, len(entries))
+
+    def _thread(self, target, *args):
+        t = threading.Thread(target=target, args=args)
+        t.daemon = True
+        t.start()
+
+    def _accept(self):
+        while True:
+            sock = self.sock.accept()[0]
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._thread(self._serve, _Client(sock))
+
+    def changed(self, *subsystems):
+        """Reports the subsystems as changed to every client (as idle
+        would). Called with the lock held."""
+        for c in self.clients:
+            c.events.update(subsystems)
+            c.wake()
+
+    def _serve(self, client):
+        with self.lock:
+            self.clients.append(client)
+        out = client.sock.makefile("wb", 65536)
+        out.write("OK MPD 0.19.0\n")
+        out.flush()
+        try:
+            self._requests(client, out)
+        except socket.error:
+            pass
+        finally:
+            with self.lock:
+                self.clients.remove(client)
+            os.close(client.rfd)
+            os.close(client.wfd)
+            client.sock.close()
+
+    def _requests(self, client, out):
+        cmdlist = None
+        while True:
+            line = client.readline()
+            if line == None:
+                return
+            if line in ("command_list_begin", "command_list_ok_begin"):
+                cmdlist = (line == "command_list_ok_begin", [])
+                continue
+            if cmdlist != None and line != "command_list_end":
+                cmdlist[1].append(line)
+                continue
+            if line == "noidle":  # Sent after idle has already returned
+                continue
+
+            if self.latency:
+                select.select([], [], [], self.latency)
+            if line == "idle":
+                self._idle(client, out)
+                continue
+            with self.lock:
+                self.roundtrips += 1
+            ok, lines = cmdlist if cmdlist != None else (False, [line])
+            cmdlist = None
+            try:
+                for l in lines:
+                    cmd, args = _args(l)
+                    with self.lock:
+                        self._command(out, cmd, args)
+                    if ok:
+                        out.write("list_OK\n")
+                out.write("OK\n")
+            except Ack as e:
+                out.write("%s\n" % e)
+            except (IndexError, KeyError, ValueError) as e:
+                out.write("%s\n" % Ack(2, cmd, "bad argument"))
+            out.flush()
+
+    def _idle(self, client, out):
+        while not client.events:
+            line = client.readline(idling=True)
+            if line == None:
+                raise socket.error()
+            elif line == "noidle":
+                break
+        with self.lock:
+            events, client.events = client.events, set()
+        for e in sorted(events):
+            out.write("changed: %s\n" % e)
+        out.write("OK\n")
+        out.flush()
+
+    def _append(self, i):
+        self.version += 1
+        self.queue.append([i, self.next_id, self.version])
+        self.next_id += 1
+        return self.next_id - 1
+
+    def _changed_queue(self, pos):
+        """Bumps the version of the songs from pos on (they moved)."""
+        self.version += 1
+        for q in self.queue[pos:]:
+            q[2] = self.version
+
+    def _queue_entry(self, out, pos):
+        i, songid = self.queue[pos][:2]
+        out.write(self.blobs[i])
+        out.write("Pos: %i\nId: %i\n" % (pos, songid))
+
+    def _pos_of(self, songid):
+        for pos, q in enumerate(self.queue):
+            if q[1] == songid:
+                return pos
+        raise Ack(50, "playid", "No such song")
+
+    def _songs(self, path):
+        if path in self.index:
+            return [self.index[path]]
+        start, end = self.subtree[path]
+        return [i for i in xrange(start, end) if self.blobs[i][0] == "f"]
+
+    def _command(self, out, cmd, args):
+        arg = args[0] if args else None
+        if cmd in ("ping", "password"):
+            pass
+        elif cmd == "status":
+            d = [("volume", 100), ("repeat", 0), ("random", 0), ("single", 0),
+                    ("consume", 0), ("playlist", self.version),
+                    ("playlistlength", len(self.queue)), ("xfade", 0),
+                    ("state", self.state)]
+            if self.current >= 0:
+                d += [("song", self.current),
+                        ("songid", self.queue[self.current][1]),
+                        ("elapsed", "12.345")]
+            out.write("".join("%s: %s\n" % v for v in d))
+        elif cmd == "stats":
+            out.write("songs: %i\ndb_update: %i\n" % (len(self.index),
+                self.db_update))
+        elif cmd == "currentsong":
+            if self.current >= 0:
+                self._queue_entry(out, self.current)
+        elif cmd == "lsinfo":
+            for i in self.children[arg or u""]:
+                out.write(self.blobs[i])
+        elif cmd == "listallinfo":
+            start, end = self.subtree[arg or u""]
+            for i in xrange(start, end):
+                out.write(self.blobs[i])
+        elif cmd in ("plchanges", "plchangesposid"):
+            v = int(arg)
+            start, end = _range(args[1] if len(args) > 1 else None,
+                    len(self.queue))
+            for pos in xrange(start, min(end, len(self.queue))):
+                q = self.queue[pos]
+                if v > self.version or q[2] > v:
+                    if cmd == "plchanges":
+                        self._queue_entry(out, pos)
+                    else:
+                        out.write("cpos: %i\nId: %i\n" % (pos, q[1]))
+        elif cmd == "playlistinfo":
+            start, end = _range(arg, len(self.queue))
+            for pos in xrange(start, min(end, len(self.queue))):
+                self._queue_entry(out, pos)
+        elif cmd == "playlistsearch":
+            if not args or len(args) % 2:
+                raise Ack(2, cmd, "incorrect arguments")
+            pairs = zip([a.lower() for a in args[::2]],
+                    [a.lower() for a in args[1::2]])
+            for pos, q in enumerate(self.queue):
+                tags = self.tags.get(q[0])
+                if tags == None:
+                    tags = self.tags[q[0]] = _tags(self.blobs[q[0]])
+                if _matches(tags, pairs):
+                    self._queue_entry(out, pos)
+        elif cmd in ("add", "addid"):
+            for i in self._songs(arg):
+                songid = self._append(i)
+            if cmd == "addid":
+                out.write("Id: %i\n" % songid)
+            self.changed("playlist")
+        elif cmd == "delete":
+            start, end = _range(arg, len(self.queue))
+            del self.queue[start:end]
+            if start <= self.current < end:
+                self.current, self.state = -1, "stop"
+            elif self.current >= end:
+                self.current -= end - start
+            self._changed_queue(start)
+            self.changed("playlist")
+        elif cmd == "clear":
+            self.queue = []
+            self.current, self.state = -1, "stop"
+            self.version += 1
+            self.changed("playlist", "player")
+        elif cmd in ("play", "playid"):
+            if arg != None:
+                self.current = int(arg) if cmd == "play" else \
+                        self._pos_of(int(arg))
+            self.current = max(self.current, 0) if self.queue else -1
+            self.state = "play" if self.current >= 0 else "stop"
+            self.changed("player")
+        elif cmd in ("next", "previous"):
+            if self.current >= 0:
+                self.current += 1 if cmd == "next" else -1
+                if not 0 <= self.current < len(self.queue):
+                    self.current, self.state = -1, "stop"
+            self.changed("player")
+        elif cmd in ("stop", "pause", "seekcur"):
+            if cmd != "seekcur":
+                self.state = "stop" if cmd == "stop" else "pause"
+            self.changed("player")
+        elif cmd == "update":
+            self.db_update += 1
+            out.write("updating_db: 1\n")
+            self.changed("update", "database")
+        else:
+            raise Ack(5, "", 'unknown command "%s"' % cmd)
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+# Benchmarks of the client's MPD paths against the stand-in server of
+# server.py. Each scenario runs in a process of its own, serving a synthetic
+# library to a client set up like main.Main sets it up, and reports the
+# wall time of the measured part, the commands served meanwhile (idle not
+# counted) and the peak memory of the process (which includes the server's
+# copy of the library, the same for every scenario).
+#
+# Usage: python bench/suite.py [-s SONGS,...] [-q QUEUE] [-t SHAPE]
+#        [-l LATENCY] [SCENARIO]...
+
+import getopt
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from library import library, queue
+from server import Server
+
+from browser import Browser
+from common import Message
+from status import Status
+from worker import EventQueue
+from wrapper import MPDListener, MPDWrapper
+
+SHAPES = {"default": {},
+        "wide": {"tracks": 1000, "albums": 1},  # Huge directories
+        "deep": {"depth": 6},  # Artists six directories down
+        "unicode": {"unicode_tags": True}}
+
+
+class Client(MPDListener):
+    """The browser and status of a client connected to the server."""
+
+    def __init__(self, server, lazy=False):
+        self.server = server
+        self.events = EventQueue()
+        self.mpd = MPDWrapper("127.0.0.1", server.port, self.events)
+        self.browser = Browser(self.mpd, lazy, None, self.events)
+        self.status = Status(self.mpd, Message(), self.events)
+        self.mpd.add_listener(self)
+        self.mpd.connect()
+        self.until(lambda: self.mpd.connected)
+
+    def mpd_changed(self, changes):
+        if "database" in changes:
+            self.browser.refresh(self.mpd.updated_paths())
+        self.status.update(changes)
+
+    def until(self, done, timeout=3600):
+        """Dispatches events until done() returns True."""
+        end = time.time() + timeout
+        while not done():
+            if time.time() > end:
+                raise RuntimeError("timed out")
+            self.events.wait(0.1)
+            self.events.dispatch()
+
+    def loaded(self):
+        self.browser.load()
+        return lambda: self.browser.db_update != None
+
+    def synced(self):
+        self.status.init()
+        return lambda: self.status.playlist.version == self.server.version
+
+    def started(self):
+        loaded, synced = self.loaded(), self.synced()
+        return lambda: loaded() and synced()
+
+
+# Scenarios: (lazy browser, setup, measured part). Both parts return a
+# function telling when they are done.
+
+def _add(c):
+    n = len(c.status.playlist.real_items)
+    c.mpd.add(c.browser.tree.songs().next().data.file)
+    return lambda: len(c.status.playlist.real_items) == n + 1
+
+
+def _scroll(c):
+    """Shows a screen from the middle of the queue (loaded on demand if the
+    queue is windowed)."""
+    pl = c.status.playlist
+    pos = len(pl) / 2
+    pl.select(pos)
+    pl.show(pos, pos + 50)
+    return lambda: pl[pos + 49] != None
+
+
+def _search(target):
+    def start(c):
+        target(c).search(u"track 12")
+        return lambda: not target(c).searching()
+    return start
+
+
+SCENARIOS = [
+        ("load", (False, None, Client.loaded)),
+        ("load-lazy", (True, None, Client.loaded)),
+        ("init", (False, None, Client.synced)),
+        ("update", (False, Client.started, _add)),
+        ("scroll", (False, Client.synced, _scroll)),
+        ("search", (False, Client.loaded, _search(lambda c: c.browser))),
+        ("filter", (False, Client.synced,
+            _search(lambda c: c.status.playlist)))]
+
+
+def run(name, songs, queued, shape, latency):
+    """Runs a scenario (in this process), returns (wall time in ms, round
+    trips, peak memory in MB)."""
+    lazy, setup, start = dict(SCENARIOS)[name]
+    entries = library(songs, **SHAPES[shape])
+    server = Server(entries, [v["file"] for v in queue(entries, queued)],
+            latency)
+    del entries
+
+    c = Client(server, lazy)
+    if setup:
+        c.until(setup(c))
+    roundtrips = server.roundtrips
+    t = time.time()
+    c.until(start(c))
+    wall = (time.time() - t) * 1000
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return wall, server.roundtrips - roundtrips, peak
+
+
+def usage(cmd):
+    print "Usage: %s [OPTIONS]... [SCENARIO]..." % cmd
+    print
+    print "-h, --help       print this message."
+    print "-s, --songs      library sizes, comma separated",
+    print "(default 10000,100000)"
+    print "-q, --queue      queue length (default 10000)"
+    print "-t, --shape      library shape: %s" % ", ".join(sorted(SHAPES))
+    print "-l, --latency    ms added to every round trip by the server"
+    print
+    print "Scenarios: %s" % ", ".join(name for name, v in SCENARIOS)
+
+
+def main(argv):
+    if argv[1:2] == ["--run"]:  # A scenario's own process
+        name, songs, queued, shape, latency = argv[2:]
+        stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+        result = run(name, int(songs), int(queued), shape, float(latency))
+        stdout.write("%f %i %f\n" % result)
+        return
+
+    try:
+        opts, names = getopt.getopt(argv[1:], "hs:q:t:l:", ["help", "songs=",
+            "queue=", "shape=", "latency="])
+        cfg = {"songs": [10000, 100000], "queue": 10000, "shape": "default",
+                "latency": 0.0}
+        for o, a in opts:
+            if o in ("-h", "--help"):
+                usage(argv[0])
+                sys.exit()
+            elif o in ("-s", "--songs"):
+                cfg["songs"] = [int(n) for n in a.split(",")]
+            elif o in ("-q", "--queue"):
+                cfg["queue"] = int(a)
+            elif o in ("-t", "--shape"):
+                cfg["shape"] = a
+            elif o in ("-l", "--latency"):
+                cfg["latency"] = float(a) / 1000
+        if cfg["shape"] not in SHAPES or \
+                any(not n in dict(SCENARIOS) for n in names):
+            raise ValueError()
+    except (getopt.GetoptError, ValueError):
+        usage(argv[0])
+        sys.exit(1)
+
+    for songs in cfg["songs"]:
+        print "%i songs, %i queued, %s shape, %.0f ms latency" % (songs,
+                cfg["queue"], cfg["shape"], cfg["latency"] * 1000)
+        print "%-10s %10s %12s %10s" % ("scenario", "wall ms", "round trips",
+                "peak MB")
+        for name in names or [name for name, v in SCENARIOS]:
+            out = subprocess.check_output([sys.executable, __file__, "--run",
+                name, str(songs), str(cfg["queue"]), cfg["shape"],
+                str(cfg["latency"])])
+            wall, roundtrips, peak = out.split()
+            print "%-10s %10.1f %12s %10.1f" % (name, float(wall), roundtrips,
+                    float(peak))
+        print
+
+if __name__ == "__main__":
+    main(sys.argv)
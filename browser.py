@@ -2,12 +2,22 @@
 # -*- coding: utf-8 -*-
 
 from re import compile, IGNORECASE
-import traceback
+import gc
+import logging
 
+import cache
 from common import Listenable
+from index import SearchIndex
+from metrics import metrics
+from query import Filter
 from list import List
-from status import Song
-from wrapper import MPDWrapper
+from wrapper import CommandError, MPDWrapper, Song
+
+_log = logging.getLogger(__name__)
+
+
+def _contains(root, path):
+    return root == "" or path == root or path.startswith(root + "/")
 
 
 class Path(object):
@@ -40,6 +50,8 @@ class Path(object):
 
 class BrowserNode(object):
 
+    __slots__ = ("mpd", "parent", "ntype")
+
     def __init__(self, mpd, parent, ntype):
         self.mpd = mpd
         self.parent = parent
@@ -48,10 +60,25 @@ class BrowserNode(object):
 
 class SongNode(BrowserNode):
 
-    def __init__(self, mpd, data, parent):
+    # There's one of these per song in the library, hence the slots and
+    # the song and path being created when asked for. ref is the song's row
+    # in the SongStore (mpd.songs).
+    __slots__ = ("ref",)
+
+    def __init__(self, mpd, ref, parent):
         super(SongNode, self).__init__(mpd, parent, "song")
-        self.data = data
-        self.path = Path(data.file)
+        self.ref = ref
+
+    @property
+    def data(self):
+        return Song(self.mpd.songs, self.ref)
+
+    @property
+    def path(self):
+        return Path(self.mpd.songs.files[self.ref])
+
+    def name(self):
+        return self.mpd.songs.files[self.ref].rpartition("/")[2]
 
     def __str__(self):
         return "%s - %s (%s)" % (self.data.artist,
@@ -111,63 +138,138 @@ class DirectoryNode(InternalNode):
     def __init__(self, mpd, path, parent):
         super(DirectoryNode, self).__init__(mpd, parent, "directory")
         self.path = path
+        self.loaded = False
 
     def __str__(self):
         return self.path.name() + "/"
 
-    def load(self):
-        children = []
-
+    def _subdirectories(self):
+        for n in self.children:
+            if n.ntype == "directory":
+                yield n
+                for c in n._subdirectories():
+                    yield c
+
+    def expand(self, entries):
+        old = dict((unicode(n.path), n) for n in self.children
+                if n.ntype == "directory")
+        dirs, songs = [], []
+        for v in entries:
+            if "directory" in v:
+                node = old.get(v["directory"])
+                if node == None:
+                    node = DirectoryNode(self.mpd, Path(v["directory"]), self)
+                dirs.append(node)
+            elif "file" in v:
+                songs.append(SongNode(self.mpd, self.mpd.songs.add(v), self))
+        self._set_children(dirs + songs)
+
+    # Builds the subtree from a flat listallinfo listing
+    def ingest(self, entries):
+        nodes = {unicode(self.path): self}
+        children = {self: ([], [])}
+        old = dict((unicode(n.path), n) for n in self._subdirectories())
+
+        def parent_of(path):
+            ppath = path.rpartition("/")[0]
+            if ppath not in nodes:  # Listing is missing the directory entry
+                return add_directory(ppath)
+            return nodes[ppath]
+
+        def add_directory(path):
+            parent = parent_of(path)
+            node = old.get(path)
+            if node == None:
+                node = DirectoryNode(self.mpd, Path(path), parent)
+            children[parent][0].append(node)
+            children[node] = ([], [])
+            nodes[path] = node
+            return node
+
+        # The collector would otherwise rescan the growing tree over and over
+        gc.disable()
         try:
-            for v in self.mpd.ls(unicode(self.path)):
+            add = self.mpd.songs.add
+            for v in entries:
                 if "directory" in v:
-                    c = DirectoryNode(self.mpd, Path(v["directory"]), self)
-                    c.load()
-                    children.append(c)
-                elif "playlist" in v:
-                    c = PlaylistNode(self.mpd, v["playlist"], self)
-                    #children.append(c)
+                    if v["directory"] not in nodes:
+                        add_directory(v["directory"])
                 elif "file" in v:
-                    c = SongNode(self.mpd, Song(v), self)
-                    children.append(c)
-        except:
-            traceback.print_exc()
-            raise
+                    parent = parent_of(v["file"])
+                    children[parent][1].append(SongNode(self.mpd, add(v),
+                        parent))
+
+            for node, (dirs, songs) in children.iteritems():
+                node._set_children(dirs + songs)
+        finally:
+            gc.enable()
+
+    def _index_of(self, node):
+        for i, n in enumerate(self.children):
+            if n is node or (n.ntype == node.ntype and n.ntype != "link" and
+                    unicode(n.path) == unicode(node.path)):
+                return i
+        return self.sel
 
+    def _set_children(self, children):
         # Add links to root and previous directory
         if self.parent != None:
             children.insert(0, LinkNode(self.mpd, self, Path(), "/"))
             children.insert(1, LinkNode(self.mpd, self,
                 self.parent.path.copy(), "../"))
 
+        prev = self.selected()
         self.children = children
-        self.select(0)
+        self.loaded = True
+        self.select(self._index_of(prev) if prev != None else 0)
+
+    def songs(self):
+        for n in self.children:
+            if n.ntype == "directory":
+                for c in n.songs():
+                    yield c
+            elif n.ntype == "song":
+                yield n
+
+    # Lists of children are replaced, never changed, so they're not copied
+    def snapshot(self):
+        snapshot, stack = {}, [self]
+        while stack:
+            node = stack.pop()
+            children = snapshot[node] = node.children
+            stack.extend(n for n in children if n.ntype == "directory")
+        return snapshot
+
+    # With a snapshot, this may run on another thread
+    def listing(self, snapshot=None):
+        children = self.children if snapshot == None else snapshot[self]
+        for n in children:
+            if n.ntype == "directory":
+                yield {"directory": unicode(n.path)}
+                for v in n.listing(snapshot):
+                    yield v
+            elif n.ntype == "song":
+                s = n.data
+                yield {"file": s.file, "artist": s.artist, "album": s.album,
+                        "title": s.title, "genre": s.genre, "time": s.time}
 
     def lookup(self, name):
         for n in self.children:
-            if n.path.name() and n.path.name() == name:
+            if n.ntype == "song":
+                if n.name() == name:
+                    return n
+            elif n.path.name() and n.path.name() == name:
                 return n
         return None
 
 
 class SearchNode(InternalNode):
 
-    def __init__(self, mpd, s):
-        super(InternalNode, self).__init__(mpd, None, "search")
+    def __init__(self, mpd, s, results):
+        super(SearchNode, self).__init__(mpd, None, "search")
         self.string = s
-        self.rl = map(lambda s: compile(s, IGNORECASE), self.string.split())
         self.path = Path()
-
-    def _search(self, node):
-        for n in node.children:
-            if n.ntype == "directory":
-                self._search(n)
-            elif n.ntype == "song" and n.data.matches_all(self.rl):
-                self.children.append(n)
-
-    def search(self, tree):
-        self.children = []
-        self._search(tree)
+        self.children = results
         self.select(0)
 
 
@@ -184,16 +286,50 @@ class LinkNode(BrowserNode):
 
 class Browser(Listenable):
 
-    def __init__(self, mpd):
+    def __init__(self, mpd, lazy=False, cache_path=None, events=None):
         super(Browser, self).__init__()
         self.mpd = mpd
+        self.lazy = lazy
+        self.cache_path = cache_path
         self.tree = DirectoryNode(mpd, Path(), None)
-        self.curr_node = None
+        self.generation = 0
+        self.index = None
+        self.filter = Filter(mpd.songs.scan, events=events,
+                name="browser search")
+        self.search_job = None
+        self.curr_node = self.tree  # Shown empty until loaded
         self.prev_node = None
         self.search_node = None
+        self.prefetch_queue = []
+        self.pending = set()  # Directories being expanded
+        self.db_update = None  # Database version the tree was loaded from
+
+    def _expand(self, node):
+        if self.lazy and not node.loaded and not node in self.pending:
+            self.pending.add(node)
+            path = unicode(node.path)
+            self.mpd.submit(lambda: self.mpd.ls(path),
+                    lambda entries: self._expanded(node, entries),
+                    lambda: self.pending.discard(node))
+
+    def _expanded(self, node, entries):
+        self.pending.discard(node)
+        node.expand(entries)
+        self.generation += 1
+        if node is self.curr_node:
+            self._queue_prefetch(node)
+            self.notify("browser_node_changed", self)
+
+    def _queue_prefetch(self, node):
+        siblings = node.parent.children if node.parent else []
+        self.prefetch_queue = [n for n in node.children + siblings
+                if n.ntype == "directory" and not n.loaded]
 
     def _set_selected(self, node):
-        if node:
+        if node != None:
+            if self.lazy:
+                self._expand(node)
+                self._queue_prefetch(node)
             self.curr_node = node
             self.notify("browser_node_changed", self)
 
@@ -204,7 +340,7 @@ class Browser(Listenable):
             if selnode.ntype == "song":
                 self.mpd.add_and_play(selnode.data.file)
             elif selnode.ntype == "playlist":
-                print(selnode.data)  # TODO
+                _log.debug("enter playlist: %s", selnode.data)  # TODO
             elif selnode.ntype == "directory":
                 self._set_selected(selnode)
             elif selnode.ntype == "link":
@@ -217,6 +353,8 @@ class Browser(Listenable):
     def go_to(self, path):
         node = self.tree
         for p in path.list:
+            if not node.loaded:
+                break
             node = node.lookup(p)
             if node == None:
                 return False
@@ -232,25 +370,216 @@ class Browser(Listenable):
             self.curr_node.select(0)  # Restore selected for current node
             self._set_selected(self.curr_node.parent)
 
+    def _db_update(self):
+        return self.mpd.stats().get("db_update")
+
+    # Runs on the I/O thread
+    def _listing(self):
+        key = self._db_update()
+        entries = cache.load(self.cache_path, key) \
+                if key and self.cache_path else None
+        if entries == None:
+            entries = self.mpd.listallinfo()
+            if key and self.cache_path:
+                cache.save(self.cache_path, key, entries)
+        return key, entries
+
     def load(self):
-        self.tree.load()
+        self.prefetch_queue = []
+        self.pending = set()
+        if self.lazy:
+            fetch = lambda: (self._db_update(), self.mpd.ls(""))
+        else:
+            fetch = self._listing
+        self.mpd.submit(fetch, lambda results: self._loaded(*results))
+        self.notify("browser_node_changed", self)
+
+    def _loaded(self, key, entries):
+        with metrics.timed("tree load"):
+            if self.lazy:
+                self.tree.expand(entries)
+            else:
+                self.tree.ingest(entries)
+        self._measure()
+        self.db_update = key
+        self.generation += 1
+        self.index = None
         if self.search_active():
             self.search(None)
         self._set_selected(self.tree)
 
+    def resume(self):
+        if self.db_update == None:
+            self.load()
+        else:
+            self.mpd.submit(self._db_update, self._resumed)
+
+    def _resumed(self, key):
+        if key != self.db_update:
+            self.refresh()
+
+    def _nearest(self, path):
+        node = self.tree
+        for p in path.list:
+            child = node.lookup(p)
+            if child == None or child.ntype != "directory" or not child.loaded:
+                break
+            node = child
+        return node
+
+    # Runs on the I/O thread, fetches the parents of directories gone
+    def _fetch(self, fetch, paths):
+        listings = {}
+        for path in paths:
+            while not path in listings:
+                try:
+                    listings[path] = fetch(path)
+                except CommandError:
+                    if not path:
+                        raise
+                    path = path.rpartition("/")[0]
+        return listings
+
+    def _listed(self, node, listings):
+        while node.parent != None and not unicode(node.path) in listings:
+            node = node.parent
+        return node
+
+    def _refresh_lazy(self, node, listings):
+        entries = listings.get(unicode(node.path))
+        if entries == None:  # Fetched again when visited
+            for c in node._subdirectories():
+                c.loaded = False
+            node.loaded = False
+            return
+        node.expand(entries)
+        for n in node.children:
+            if n.ntype == "directory" and n.loaded:
+                self._refresh_lazy(n, listings)
+
+    def _measure(self):
+        metrics.set("tree directories",
+                sum(1 for n in self.tree._subdirectories()))
+        metrics.set("songs stored", len(self.mpd.songs))
+
+    def _save_cache(self):
+        key = self.db_update
+        if key and self.cache_path:
+            # Only the structure is copied here, the entries (for a large
+            # library, seconds of work) are built on the I/O thread
+            tree = self.tree
+            snapshot = tree.snapshot()
+            self.mpd.submit(lambda: cache.save(self.cache_path, key,
+                list(tree.listing(snapshot))))
+
+    # Called from the search worker
+    def _search_index(self):
+        index, generation = self.index, self.generation
+        if index == None and not self.lazy:
+            index = SearchIndex(self.mpd.songs)
+            index.build(self.tree)
+            if generation == self.generation:
+                self.index = index
+        return index
+
+    def refresh(self, paths=None):
+        roots = []
+        for p in sorted(set(paths or [""])):
+            if not any(_contains(r, p) for r in roots):
+                roots.append(p)
+        nodes = []
+        for p in roots:
+            node = self._nearest(Path(p))
+            if not node in nodes:
+                nodes.append(node)
+
+        fetch = self.mpd.listallinfo
+        fetched = [unicode(n.path) for n in nodes]
+        if self.lazy:
+            fetch = self.mpd.ls
+            n = self.curr_node
+            while n != None:
+                path = unicode(n.path)
+                if n.ntype == "directory" and n.loaded and \
+                        not path in fetched and \
+                        any(_contains(r, path) for r in fetched):
+                    fetched.append(path)
+                n = n.parent
+
+        def fetch_all():
+            return self._db_update(), self._fetch(fetch, fetched)
+        self.mpd.submit(fetch_all,
+                lambda results: self._refreshed(nodes, *results))
+
+    def _refreshed(self, nodes, key, listings):
+        search = self.search_node.string if self.search_active() else None
+        self.search(None)
+        self.prefetch_queue = []
+
+        # Directories that are gone are dropped by refreshing their parents
+        listed = []
+        for node in nodes:
+            node = self._listed(node, listings)
+            if not node in listed:
+                listed.append(node)
+        with metrics.timed("tree refresh"):
+            for node in listed:
+                if self.lazy:
+                    self._refresh_lazy(node, listings)
+                elif unicode(node.path) in listings:
+                    node.ingest(listings[unicode(node.path)])
+        self._measure()
+        self.db_update = key
+        if not self.lazy:
+            self._save_cache()
+        self.generation += 1
+        self.index = None
+
+        if self.curr_node != None:
+            self._set_selected(self._nearest(self.curr_node.path))
+        else:
+            self._set_selected(self.tree)
+        if search != None:
+            self.search(search)
+
+    def prefetch(self, n=4):
+        if not self.pending:
+            while n > 0 and self.prefetch_queue:
+                self._expand(self.prefetch_queue.pop(0))
+                n -= 1
+        return self.prefetch_pending()
+
+    def prefetch_pending(self):
+        return len(self.prefetch_queue) > 0 and not self.pending
+
     def path_str(self, delim="/"):
         if self.curr_node != None:
             return delim.join(self.curr_node.path.list)
         return ""
 
+    def _search_pool(self, query):
+        index = self._search_index()
+        nodes = index.candidates(query.terms) if index else None
+        return self.tree.songs() if nodes == None else nodes
+
+    def _search_progress(self, job):
+        if job is self.search_job and self.curr_node is self.search_node:
+            if self.search_node.sel < 0:
+                self.search_node.select(0)
+            self.notify("browser_node_changed", self)
+
     def _search_start(self, s):
-        self.search_node = SearchNode(self.mpd, s)
-        self.search_node.search(self.tree)
+        self.search_job = self.filter.start(s, self.generation,
+                self._search_pool, self._search_progress)
+        self.search_node = SearchNode(self.mpd, s, self.search_job.items)
         self.prev_node = self.curr_node
         self.curr_node = self.search_node
         self.notify("browser_search_started", self)
 
     def _search_stop(self):
+        if self.search_job:
+            self.search_job.cancel()
+            self.search_job = None
         self.curr_node = self.prev_node
         self.search_node = None
         self.notify("browser_search_stopped", self)
@@ -264,6 +593,9 @@ class Browser(Listenable):
     def search_active(self):
         return self.search_node != None
 
+    def searching(self):
+        return self.search_job != None and not self.search_job.done
+
     def select(self, index, rel=False):
         self.curr_node.select(index, rel)
         self.notify("browser_selected_changed", self)
@@ -0,0 +1,65 @@
+import errno
+import gc
+import logging
+import marshal
+import os
+import zlib
+
+from wrapper import song_fields
+
+# On-disk snapshot of the MPD database listing, keyed by the db_update
+# timestamp reported by the stats command. Songs are stored as flat tuples
+# (with the defaults for missing tags already filled in) since that's a lot
+# faster to decode than one dict per entry.
+
+_log = logging.getLogger(__name__)
+
+
+CACHE_VERSION = 1
+
+_SONG_KEYS = ("file", "artist", "album", "title", "genre", "time")
+
+
+def cache_path(host, port):
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "tbmpcpy", "%s_%s.db" % (host, port))
+
+
+def load(path, key):
+    """Returns the cached listing if it was stored with the given key,
+    otherwise None."""
+    gc.disable()
+    try:
+        with open(path, "rb") as f:
+            version, stored_key, dirs, songs = marshal.loads(
+                    zlib.decompress(f.read()))
+        if version != CACHE_VERSION or stored_key != key:
+            return None
+        return ([{"directory": d} for d in dirs] +
+                [dict(zip(_SONG_KEYS, v)) for v in songs])
+    except (IOError, EOFError, ValueError, TypeError, zlib.error):
+        return None
+    finally:
+        gc.enable()
+
+
+def save(path, key, entries):
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            _log.warning("couldn't create cache directory: %s", e)
+            return False
+
+    dirs = [v["directory"] for v in entries if "directory" in v]
+    songs = [song_fields(v) for v in entries if "file" in v]
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(zlib.compress(marshal.dumps((CACHE_VERSION, key, dirs,
+                songs)), 1))
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        _log.warning("couldn't write cache: %s", e)
+        return False
+    return True
@@ -1,10 +1,13 @@
 from collections import namedtuple
+import logging
 import re
 
 from common import *
 
 # Vi-like command line, with command and argument autocomplete.
 
+_log = logging.getLogger(__name__)
+
 
 MatchTuple = namedtuple("MatchTuple", "name description")
 
@@ -120,7 +123,7 @@ class CommandLine(Listenable):
         s = re.findall(re.compile(r'(\"\w+\"|\w+)'), self.buf)
         if self.buf.endswith(" "):
             s.append("")
-        print(s)
+        _log.debug("split: %s", s)
         return s[0] if len(s) > 0 else None, s[1:]
 
     def _autocomplete_clear(self):
@@ -174,7 +177,7 @@ class CommandLine(Listenable):
         else:
             self.buf = re.sub(r"(.*)" + args[-1],
                     r"\g<1>" + self.matched.current().name, self.buf)
-        print(self.buf)
+        _log.debug("autocompleted: %s", self.buf)
 
     def _autocomplete_prev(self):
         self.matched.select_prev()
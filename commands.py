@@ -226,11 +226,10 @@ class PlaylistGoToCurrentCommand(ResCommand):
                 "Go to current")
 
     def execute(self, *args):
-        try:
-            if self.status.current != None:
-                self.status.playlist.select(self.status.current.pos)
-        except CommandError:
-            raise CommandExecutionError("Couldn't execute 'clear' command")
+        if self.status.current != None:
+            index = self.status.playlist.index_of(self.status.current)
+            if index >= 0:
+                self.status.playlist.select(index)
 
 
 #### Browser commands ####
@@ -1,10 +1,59 @@
+import random
 import time
+from collections import OrderedDict
 
 
 def time_in_millis():
     return int(round(time.time() * 1000))
 
 
+class LRUCache(object):
+    """A dict holding at most size items, dropping the least recently used
+    ones first."""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        self.items.clear()
+
+    def get(self, key, default=None):
+        if not key in self.items:
+            return default
+        v = self.items[key] = self.items.pop(key)
+        return v
+
+    def put(self, key, v):
+        self.items.pop(key, None)
+        self.items[key] = v
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+
+class Backoff(object):
+    """Exponentially growing delays (from first up to limit) with random
+    jitter, so that clients don't all retry at the same time."""
+
+    def __init__(self, first, limit, factor=2):
+        self.first = first
+        self.limit = limit
+        self.factor = factor
+        self.reset()
+
+    def next(self):
+        """Returns the delay before the next attempt."""
+        delay = self.delay
+        self.delay = min(self.delay * self.factor, self.limit)
+        return delay * random.uniform(0.5, 1.0)
+
+    def reset(self):
+        self.delay = self.first
+
+
 class Listenable(object):
 
     def __init__(self):
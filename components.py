@@ -14,6 +14,10 @@ from ui import *
 from sys import maxsize
 
 
+# Formatted rows kept per list component (a few screens' worth)
+ROW_CACHE_SIZE = 512
+
+
 class MainComponent(Component):
 
     def __init__(self, tb, islist=False):
@@ -41,8 +45,21 @@ class ProgressBarUI(Component, StatusListener):
         self.set_dim(0, 0, tb.width(), 1)
         self.status = status
         self.status.add_listener(self)
+        self.drawn_width = None
+
+    def _elapsed_width(self):
+        elapsed = self.status.progress.elapsed()
+        if elapsed >= 0 and elapsed <= 1:
+            return max(0, int(elapsed * self.w))
+        return -1
+
+    def is_dirty(self):
+        # Progress ticks only matter once the bar grows by a cell
+        return (super(ProgressBarUI, self).is_dirty() or
+                self._elapsed_width() != self.drawn_width)
 
     def draw(self):
+        self.drawn_width = self._elapsed_width()
         elapsed = self.status.progress.elapsed()
         if elapsed >= 0 and elapsed <= 1:
             self.change_cells_format(0, 0, self._format_playing(elapsed))
@@ -85,6 +102,7 @@ class MessageUI(Component, MessageListener):
             self.change_cells_format(0, 0, f)
 
     def message_changed(self, unused_msg):
+        self.invalidate()
         self.show() if self.msg.has_message() else self.hide()
 
 
@@ -92,8 +110,10 @@ class ListUI(MainComponent, ListListener):
 
     def __init__(self, tb, list):
         super(ListUI, self).__init__(tb, True)
+        self.opaque = True
         self.list = list
         self.start = 0
+        self.last_sel = -1
 
     def _fix_bounds(self):
         if len(self.list) > 0:
@@ -106,19 +126,37 @@ class ListUI(MainComponent, ListListener):
     def _handle_resize(self):
         self._fix_bounds()
 
+    def _selection_moved(self, sel):
+        """Invalidates the rows of the previously and the newly selected
+        item, or everything if the list had to scroll."""
+        start = self.start
+        self._fix_bounds()
+        if self.start != start:
+            self.invalidate()
+        else:
+            self.invalidate([self.last_sel - start, sel - start])
+        self.last_sel = sel
+
+    def _draw_row(self, y):
+        p = y + self.start
+        f = self._format(self.list[p], y, p) if p < len(self.list) else Format()
+        self.change_row_formats(y, [(0, f)])
+
     def draw(self):
-        length = len(self.list)
-        empty = Format("".ljust(self.w))
         for y in xrange(self.h):
-            p = y + self.start
-            f = self._format(self.list[p], y, p) if p < length else empty
-            self.change_cells_format(0, y, f)
+            self._draw_row(y)
+
+    def draw_rows(self, rows):
+        for y in rows:
+            self._draw_row(y)
 
     def list_changed(self, l):
         self._fix_bounds()
+        self.last_sel = self.list.sel
+        self.invalidate()
 
     def list_selected_changed(self, l):
-        self._fix_bounds()
+        self._selection_moved(self.list.sel)
 
     def search(self, s):
         self.list.search(s)
@@ -143,22 +181,43 @@ class PlaylistUI(ListUI, StatusListener):
     def __init__(self, tb, status):
         super(PlaylistUI, self).__init__(tb, status.playlist)
         self.status = status
+        self.status.add_listener(self)
         self.list.add_listener(self)
+        self.rows = LRUCache(ROW_CACHE_SIZE)
 
-    def draw(self):
+    def _draw_row(self, y):
         length = len(self.list)
-        numw = 0
-        if length > 0:
-            numw = int(math.floor(math.log10(len(self.list)))) + 2
-        for y in xrange(self.h):
-            pos = y + self.start
-            if pos < length:
-                left, right = format_playlist_song(self.list[pos], pos,
-                        pos == self.list.sel,
-                        self.list[pos] == self.status.current,
-                        self.w, numw)
-                self.change_cells_format(0, y, left)
-                self.change_cells_format(self.w - len(right.s), y, right)
+        pos = y + self.start
+        if pos < length:
+            numw = int(math.floor(math.log10(length))) + 2
+            song = self.list[pos]
+            selected = pos == self.list.sel
+            if song == None:  # Not loaded yet (windowed queue)
+                f = format_playlist_pending(pos, selected, self.w, numw)
+                self.change_row_formats(y, [(0, f)])
+                return
+            current = song == self.status.current
+            key = (song.songid, pos, self.w, numw, selected, current)
+            row = self.rows.get(key)
+            if row == None:
+                left, right = format_playlist_song(song, pos, selected,
+                        current, self.w, numw)
+                row = [(0, left), (self.w - len(right.s), right)]
+                self.rows.put(key, row)
+            self.change_row_formats(y, row)
+        else:
+            self.change_row_formats(y, [])
+
+    def draw(self):
+        self.list.show(self.start, self.start + self.h)
+        super(PlaylistUI, self).draw()
+
+    def list_changed(self, l):
+        self.rows.clear()
+        super(PlaylistUI, self).list_changed(l)
+
+    def current_changed(self):
+        self.invalidate()
 
     def list_search_started(self, unused_ref):
         pass
@@ -229,6 +288,12 @@ class TextComponent(MainComponent):
     def set_start(self, start, rel=False):
         self.start = (self.start + start) if rel else start
         self._fix_bounds()
+        self.invalidate()
+
+    def set_text(self, tlist):
+        self.tlist = tlist
+        self._fix_bounds()
+        self.invalidate()
 
 
 class BrowserBar(Component, BrowserListener):
@@ -243,22 +308,27 @@ class BrowserBar(Component, BrowserListener):
         f.add(" Browse > ", termbox.WHITE | termbox.BOLD, termbox.BLACK)
         if self.browser.search_active():
             f.add("Filter: ", termbox.WHITE, termbox.BLACK)
-            if len(self.node) > 0:
+            if len(self.node) > 0 or self.browser.searching():
                 f.add(self.node.string, termbox.WHITE, termbox.BLACK)
             else:
                 f.add(self.node.string, termbox.RED, termbox.BLACK)
+            if self.browser.searching():
+                f.add(text_searching, termbox.WHITE, termbox.BLACK)
         else:
             f.add(self.browser.path_str(" > "), termbox.WHITE, termbox.BLACK)
         self.change_cells_format(0, 0, f)
 
     def browser_node_changed(self, browser):
         self.node = self.browser.curr_node
+        self.invalidate()
 
     def browser_search_started(self, browser):
         self.node = self.browser.curr_node
+        self.invalidate()
 
     def browser_search_stopped(self, browser):
         self.node = self.browser.curr_node
+        self.invalidate()
 
 
 class PlaylistBar(Component, ListListener):
@@ -276,10 +346,12 @@ class PlaylistBar(Component, ListListener):
         f.add(" Playlist ", termbox.WHITE | termbox.BOLD, termbox.BLACK)
         if self.search_active:
             f.add("Filter: ", termbox.WHITE, termbox.BLACK)
-            if len(self.playlist) > 0:
+            if len(self.playlist) > 0 or self.playlist.searching():
                 f.add(self.search_string, termbox.WHITE, termbox.BLACK)
             else:
                 f.add(self.search_string, termbox.RED, termbox.BLACK)
+            if self.playlist.searching():
+                f.add(text_searching, termbox.WHITE, termbox.BLACK)
         else:
             f.add(self.length_str, termbox.WHITE, termbox.BLACK)
         self.change_cells_format(0, 0, f)
@@ -290,26 +362,32 @@ class PlaylistBar(Component, ListListener):
             self.length_str += ", %s)" % playtime_str(self.playlist.playtime)
         else:
             self.length_str += ")"
+        self.invalidate()
 
     def list_search_started(self, unused_list):
         self.search_active = True
         self.search_string = self.playlist.search_string
+        self.invalidate()
 
     def list_search_stopped(self, unused_list):
         self.search_active = False
+        self.invalidate()
 
 
 class BrowserUI(MainComponent, BrowserListener):
 
     def __init__(self, tb, browser):
         super(BrowserUI, self).__init__(tb, True)
+        self.opaque = True
         self.browser = browser
         self.browser.add_listener(self)
         self.start = 0
-        self.node = None
+        self.node = browser.curr_node
+        self.last_sel = -1
+        self.rows = LRUCache(ROW_CACHE_SIZE)
 
     def _fix_bounds(self):
-        if len(self.node) > 0:
+        if self.node and len(self.node) > 0:
             if (self.node.sel - self.start) >= self.h:
                 self.start = self.node.sel - self.h + 1
             if self.node.sel < self.start:
@@ -319,35 +397,56 @@ class BrowserUI(MainComponent, BrowserListener):
     def _handle_resize(self):
         self._fix_bounds()
 
+    def _draw_row(self, y):
+        length = len(self.node) if self.node else 0
+        pos = y + self.start
+        if pos < length:
+            numw = int(math.floor(math.log10(length))) + 2
+            item = self.node[pos]
+            selected = pos == self.node.sel
+            key = (item, pos, self.w, numw, selected)
+            f = self.rows.get(key)
+            if f == None:
+                f = format_browser_item(item, pos, selected, self.w, numw)
+                self.rows.put(key, f)
+        else:
+            f = Format()
+        self.change_row_formats(y, [(0, f)])
+
     def draw(self):
-        if not self.node:
-            return
-        length = len(self.node)
-        numw = 0
-        if length > 0:
-            numw = int(math.floor(math.log10(len(self.node)))) + 2
-        empty = Format("".ljust(self.w))
         for y in xrange(self.h):
-            pos = y + self.start
-            if pos < length:
-                f = format_browser_item(self.node[pos], pos,
-                        pos == self.node.sel, self.w, numw)
-                self.change_cells_format(0, y, f)
+            self._draw_row(y)
 
-    def browser_node_changed(self, browser):
+    def draw_rows(self, rows):
+        for y in rows:
+            self._draw_row(y)
+
+    def _node_changed(self):
         self.node = self.browser.curr_node
+        self.rows.clear()
         self._fix_bounds()
+        self.last_sel = self.node.sel if self.node else -1
+        self.invalidate()
+
+    def browser_node_changed(self, browser):
+        self._node_changed()
 
     def browser_selected_changed(self, browser):
+        if not self.node:
+            return
+        start = self.start
         self._fix_bounds()
+        if self.start != start:
+            self.invalidate()
+        else:
+            self.invalidate([self.last_sel - start, self.node.sel - start])
+        self.last_sel = self.node.sel
 
     def browser_search_started(self, browser):
-        self.node = self.browser.curr_node
-        self._fix_bounds()
+        self._node_changed()
 
     def browser_search_stopped(self, browser):
-        self.node = self.browser.curr_node
-        self._fix_bounds()
+        self._node_changed()
 
     def search(self, s):
         self.browser.search(s)
@@ -383,7 +482,11 @@ class CurrentSongUI(Component, StatusListener):
                     termbox.WHITE, termbox.BLACK)
         return f
 
+    def current_changed(self):
+        self.invalidate()
+
     def state_changed(self, s):
+        self.invalidate()
         self.show() if s in ["play", "pause"] else self.hide()
 
 
@@ -472,10 +575,12 @@ class CommandLineUI(Component, CommandLineListener):
     def line_changed(self, unused_cl):
         line = ":" + self.cl.buf
         self.lines = [line[i:i + self.w] for i in range(0, len(line), self.w)]
+        self.invalidate()
         self.fix_height()
         self.fix_cursor()
 
     def matched_changed(self, unused_cl):
+        self.invalidate()
         if self.cl.matched:
             self.matchedw = self.MatchedWin(self.tb, self.cl.matched)
             self.set_pref_dim(-1, self.matchedw.h + 1)
@@ -485,6 +590,7 @@ class CommandLineUI(Component, CommandLineListener):
 
     def matched_selected_changed(self, unused_cl):
         self.matchedw.select(self.cl.matched.pos)
+        self.invalidate()
 
     def set_command_line(self, cl):
         if self.cl:
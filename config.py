@@ -51,6 +51,8 @@ text_msg_prefix = {
         "warning": "Warning",
         "error": "Error"
 }
+text_searching = u" (searching…)"
+text_loading = u"…"
 
 
 def length_str(time):
@@ -73,7 +75,7 @@ def format_browser_item(node, pos, selected, w, numw):
 
     if selected:
         f.set_color(*color_browser_selected)
-        f.add("".ljust(max(0, w - len(f.s))), *color_browser_selected)
+        f.pad(w, *color_browser_selected)
     return f
 
 
@@ -88,9 +90,22 @@ def format_playlist_song(song, pos, selected, current, w, numw):
     if selected:
         left.set_color(*color_playlist_selected)
         right.set_color(*color_playlist_selected)
-        left.add("".ljust(max(0, w - len(left.s))), *color_playlist_selected)
+        left.pad(w, *color_playlist_selected)
     if current:
         left.set_bold()
         right.set_bold()
         left.replace(0, ">", BLUE, BLACK)
     return left, right
+
+
+def format_playlist_pending(pos, selected, w, numw):
+    """Formats the row of a song that hasn't been loaded yet."""
+    f = Format()
+
+    f.add(str(pos + 1).rjust(numw), *color_playlist_number)
+    f.add(" %s" % text_loading, *color_playlist_line)
+
+    if selected:
+        f.set_color(*color_playlist_selected)
+        f.pad(w, *color_playlist_selected)
+    return f
@@ -0,0 +1,104 @@
+from array import array
+from bisect import bisect_right
+import gc
+
+# Inverted index over the artist, title and album of the songs in the
+# browser tree. Every field is split on whitespace into lower-case tokens,
+# and since a search term never contains whitespace a term can only match
+# inside a single token. Terms are looked up with a substring search over
+# the (much smaller) token vocabulary, giving the candidate songs that the
+# regexes then only have to verify.
+
+
+_REGEX_CHARS = frozenset(".^$*+?{}[]\\|()")
+
+
+def is_plain(term):
+    return not any(c in _REGEX_CHARS for c in term)
+
+
+class SearchIndex(object):
+
+    def __init__(self, songs):
+        self.songs = songs  # The SongStore the nodes' refs point into
+        self.nodes = []
+        self.tokens = {}
+        self.postings = []
+        self._blob = None
+        self._offsets = None
+
+    def _add_all(self, nodes):
+        tokens, postings = self.tokens, self.postings
+        artists, titles, albums = (self.songs.artists, self.songs.titles,
+                self.songs.albums)
+        sid = len(self.nodes)
+        for n in nodes:
+            ref = n.ref
+            for t in set(u" ".join((artists[ref], titles[ref], albums[ref]))
+                    .lower().split()):
+                tid = tokens.get(t)
+                if tid == None:
+                    tid = tokens[t] = len(postings)
+                    postings.append(array("i"))
+                postings[tid].append(sid)
+            sid += 1
+        self.nodes.extend(nodes)
+        self._blob = None
+
+    def build(self, tree):
+        gc.disable()
+        try:
+            self._add_all(list(tree.songs()))
+        finally:
+            gc.enable()
+
+    def _vocabulary(self):
+        if self._blob == None:
+            words = [None] * len(self.tokens)
+            for t, tid in self.tokens.iteritems():
+                words[tid] = t
+            self._offsets = array("i")
+            offset = 0
+            for w in words:
+                self._offsets.append(offset)
+                offset += len(w) + 1
+            self._blob = u"\n".join(words)
+        return self._blob, self._offsets
+
+    def _matching(self, term):
+        """Returns the postings of all tokens that contain term."""
+        blob, offsets = self._vocabulary()
+        matched = []
+        i = blob.find(term)
+        while i >= 0:
+            tid = bisect_right(offsets, i) - 1
+            matched.append(self.postings[tid])
+            if tid + 1 >= len(offsets):
+                break
+            i = blob.find(term, offsets[tid + 1])
+        return matched
+
+    def candidates(self, terms):
+        """Returns the songs (in tree order) that may match all terms, or
+        None if none of the terms can be used to narrow down the search."""
+        per_term = []
+        for term in terms:
+            if is_plain(term):
+                postings = self._matching(term.lower())
+                per_term.append((sum(len(p) for p in postings), postings))
+        if not per_term:
+            return None
+
+        per_term.sort(key=lambda v: v[0])
+        ids = set()
+        for p in per_term[0][1]:
+            ids.update(p)
+        for total, postings in per_term[1:]:
+            # Once the set is small, verifying it is cheaper than merging
+            if not ids or total > 8 * len(ids):
+                break
+            matched = set()
+            for p in postings:
+                matched.update(p)
+            ids.intersection_update(matched)
+        return [self.nodes[i] for i in sorted(ids)]
@@ -0,0 +1,145 @@
+import logging
+import sys
+import threading
+from collections import deque
+from logging.handlers import RotatingFileHandler
+
+from worker import Worker
+
+# Logging that never makes the UI thread wait for the disk: records go to an
+# in-memory ring buffer and are formatted and written by a background thread
+# to a file that is rotated by size. Modules log through
+# logging.getLogger(__name__), so levels can be set per module.
+
+
+FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+RING_SIZE = 4096  # Records waiting to be written, the oldest are dropped
+MAX_BYTES = 1024 * 1024  # Size at which the file is rotated
+BACKUPS = 3
+
+LEVELS = {"debug": logging.DEBUG, "info": logging.INFO,
+        "warning": logging.WARNING, "error": logging.ERROR}
+
+_handler = None
+_streams = None
+
+
+def parse_levels(s):
+    """Parses "LEVEL[,MODULE=LEVEL]..." (e.g. "info,wrapper=debug") into the
+    default level and the levels by module. Raises ValueError if a level is
+    unknown."""
+    default, modules = logging.INFO, {}
+    for part in s.split(","):
+        name, sep, level = part.rpartition("=")
+        if not level in LEVELS:
+            raise ValueError(level)
+        if sep:
+            modules[name] = LEVELS[level]
+        else:
+            default = LEVELS[level]
+    return default, modules
+
+
+class RingHandler(logging.Handler):
+    """Buffers records and passes them on to target from a worker thread, a
+    batch at a time. If the writer falls behind, the oldest records are
+    dropped rather than blocking the caller."""
+
+    def __init__(self, target, size=RING_SIZE):
+        logging.Handler.__init__(self)  # Old-style class in Python 2
+        self.target = target
+        self.records = deque(maxlen=size)
+        self.dropped = 0
+        self.scheduled = False
+        self.worker = Worker("log")
+
+    def emit(self, record):
+        # Called with the handler's lock held
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append(record)
+        if not self.scheduled:
+            self.scheduled = True
+            self.worker.submit(self._write)
+
+    def _take(self):
+        self.acquire()
+        try:
+            records, dropped = list(self.records), self.dropped
+            self.records.clear()
+            self.dropped = 0
+            self.scheduled = False
+        finally:
+            self.release()
+        return records, dropped
+
+    def _write(self):
+        records, dropped = self._take()
+        if dropped:
+            self.target.handle(logging.makeLogRecord({"name": "log",
+                "levelno": logging.WARNING, "levelname": "WARNING",
+                "msg": "%i records dropped" % dropped}))
+        for record in records:
+            self.target.handle(record)
+        self.target.flush()
+
+    def close(self, timeout=5):
+        """Waits (at most timeout seconds) for what's still buffered to be
+        written."""
+        written = threading.Event()
+        self.worker.submit(self._write)
+        self.worker.submit(written.set)
+        written.wait(timeout)
+        self.target.close()
+        logging.Handler.close(self)
+
+
+class _Stream(object):
+    """File-like object logging each line written to it."""
+
+    def __init__(self, logger, level):
+        self.logger = logger
+        self.level = level
+        self.buf = ""
+
+    def write(self, s):
+        lines = (self.buf + s).split("\n")
+        self.buf = lines.pop()
+        for line in lines:
+            self.logger.log(self.level, "%s", line)
+
+    def flush(self):
+        pass
+
+
+def start(path, default=logging.INFO, modules={}):
+    """Logs to path from now on, at the given default level and levels by
+    module. Whatever is still written to stdout and stderr (which would
+    garble the screen) is logged too."""
+    global _handler, _streams
+    logging.raiseExceptions = False  # Errors writing the log are ignored
+    target = RotatingFileHandler(path, maxBytes=MAX_BYTES,
+            backupCount=BACKUPS)
+    target.setFormatter(logging.Formatter(FORMAT))
+    _handler = RingHandler(target)
+    root = logging.getLogger()
+    root.addHandler(_handler)
+    root.setLevel(default)
+    for name, level in modules.iteritems():
+        logging.getLogger(name).setLevel(level)
+
+    _streams = sys.stdout, sys.stderr
+    sys.stdout = _Stream(logging.getLogger("stdout"), logging.INFO)
+    sys.stderr = _Stream(logging.getLogger("stderr"), logging.ERROR)
+
+
+def stop():
+    """Writes the buffered records and restores stdout and stderr."""
+    global _handler, _streams
+    if _streams != None:
+        sys.stdout, sys.stderr = _streams
+        _streams = None
+    if _handler != None:
+        logging.getLogger().removeHandler(_handler)
+        _handler.close()
+        _handler = None
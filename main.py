@@ -1,26 +1,35 @@
 #!/usr/bin/python
 # -*- encoding: utf-8 -*-
 
+import errno
 import getopt
+import log
+import logging
 import select
 import sys
 import termbox
+import time
 import traceback
 
 from browser import *
+from cache import cache_path
 from common import *
 from components import *
 from help import *
 from list import *
+from metrics import metrics, ms_since
 from search import *
 from states import *
 from status import *
 from ui import *
+from worker import EventQueue
 from wrapper import *
 
 
-MPD_RECONNECT = 10000
-MPD_UPDATE = 2000
+PROGRESS_UPDATE = 1000
+METRICS_INTERVAL = 60000  # How often the metrics file is written
+
+_log = logging.getLogger("main")
 
 
 class UI(VerticalLayout):
@@ -41,7 +50,8 @@ class UI(VerticalLayout):
         main = [["playlist", PlaylistUI, False, termbox, status],
                 ["browser", BrowserUI, False, termbox, browser],
                 ["help", TextComponent, False, termbox, help_text, "Help",
-                    True]]
+                    True],
+                ["stats", TextComponent, False, termbox, [], "Stats", True]]
 
         bottom = [["current_song", CurrentSongUI, True, termbox, status],
                 ["progress_bar", ProgressBarUI, True, termbox, status],
@@ -62,20 +72,31 @@ class UI(VerticalLayout):
         for oc in self.top:
             oc.show() if (oc is o) else oc.hide()
 
+    def draw(self):
+        t = time.time()
+        if super(UI, self).draw():
+            metrics.record("frame", ms_since(t))
+
 
-class Main(object):
+class Main(MPDListener):
 
     def __init__(self, cfg):
-        self.mpd = MPDWrapper(cfg["host"], cfg["port"])
+        self.events = EventQueue()
+        self.mpd = MPDWrapper(cfg["host"], cfg["port"], self.events,
+                cfg["timeout"])
+        self.synced = False  # Loaded from MPD at least once
         self.termbox = None
+        self.tty = None
         self.cfg = cfg
         self.states = {}
         self.pstate = None
         self.state = None
+        self.metrics_at = 0  # When the metrics file is due to be written
 
     def change_state(self, s, args={}):
         if s in self.states:
-            self.pstate = self.state
+            if self.states[s] is not self.state:
+                self.pstate = self.state
             self.state = self.states[s]
             self.state.activate(args)
 
@@ -84,44 +105,73 @@ class Main(object):
             self.pstate, self.state = self.state, self.pstate
             self.state.activate(args)
 
-    def auth(self):
-        if self.mpd.connected and self.cfg["password"]:
-            if not self.mpd.auth(self.cfg["password"]):
-                self.msg.error("Couldn't auth!", 3)
-                return False
-        return True
-
-    def connect(self):
-        if self.mpd.connect():
-            self.msg.info("Connected to %s:%s!" %
-                    (self.mpd.host, self.mpd.port), 1)
+    def mpd_changed(self, changes):
+        if "database" in changes:
+            self.browser.refresh(self.mpd.updated_paths())
+            self.msg.info("Database updated!", 4)
+        if "stored_playlist" in changes:
+            pass  # TODO: update stored playlists
+        self.status.update(changes)
+
+    def mpd_connected(self, connected, message):
+        if not connected:
+            self.msg.error(message, 3)
+        elif self.synced:  # Reconnected, only fetch what has changed
+            self.msg.info(message, 1)
+            self.browser.resume()
+            self.status.resume()
         else:
-            self.msg.error("Couldn't connect to %s:%s" %
-                    (self.mpd.host, self.mpd.port), 3)
+            self.synced = True
+            self.msg.info(message, 1)
+            self.browser.load()
+            self.status.init()
+
+    def mpd_error(self, message):
+        self.msg.error(message, 3)
+
+    def _timeout(self, ts):
+        """Returns the time (in seconds) until the next timer is due, or None
+        if there's nothing to wait for but input and MPD events."""
+        deadlines = []
+        if self.status.is_playing():
+            deadlines.append(ts + PROGRESS_UPDATE)
+        if self.msg.has_message():
+            deadlines.append(self.msg.timestamp + self.msg.timeout * 1000)
+        if self.browser.prefetch_pending():
+            deadlines.append(ts)
+        if self.cfg["metrics"]:
+            deadlines.append(self.metrics_at)
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - ts) / 1000.0
+
+    def _wait(self, timeout):
+        try:
+            return select.select([self.tty, self.events], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:  # E.g. SIGWINCH (handled by termbox)
+                raise
+        return []
 
     def event_loop(self):
         ts = time_in_millis()
-        retry_conn = False
-        retry_ts, idle_ts = ts, ts
+        backlog = False  # Whether termbox may still hold unread input
 
         while True:
+            # MPD I/O (including reconnecting) happens in the background,
+            # the results arrive as events
+            self.events.dispatch()
             self.ui.draw()
 
-            # Handle MPD connection
-            if self.mpd.connected:
-                self.mpd.idle()
-            elif not retry_conn:
-                retry_conn = True
-                retry_ts = ts
-            elif (ts - retry_ts) >= MPD_RECONNECT:
-                retry_conn = False
-                self.connect()
-                self.auth()
-                self.browser.load()
-                self.status.init()
+            # Sleep until there's input, an MPD event or a timer is due.
+            # Input termbox has already read doesn't wake select, so there's
+            # no sleeping while some is left
+            self._wait(0 if backlog else self._timeout(ts))
 
             # Handle termbox events
-            ev = self.termbox.peek_event(1000)
+            ev = self.termbox.peek_event(0)
+            handled = ev != None
+            backlog = False
             while ev:
                 (etype, ch, key, mod, w, h) = ev
 
@@ -130,12 +180,17 @@ class Main(object):
                 elif etype == termbox.EVENT_KEY:
                     self.state.key_event(ch, key, mod)
 
-                if self.mpd.has_changes():
+                if self.events.pending():
+                    backlog = True
                     break
-                ev = self.termbox.peek_event()
+                ev = self.termbox.peek_event(0)
                 if ev:
                     self.ui.draw()
 
+            # Expand browser directories in the background (lazy mode)
+            if not handled:
+                self.browser.prefetch()
+
             ts = time_in_millis()
 
             # Update elapsed time if playing (rough estimate)
@@ -147,35 +202,35 @@ class Main(object):
             # Update message timer
             self.msg.update(ts)
 
-            # Update MPD data if necessary
-            if (ts - idle_ts) >= MPD_UPDATE or self.mpd.has_changes():
-                idle_ts = ts
-                self.mpd.noidle()
-                changes = self.mpd.get_changes()
-                if "database" in changes:
-                    self.browser.load()
-                    self.msg.info("Database updated!", 4)
-                    pass  # TODO: update database
-                if "stored_playlist" in changes:
-                    pass  # TODO: update stored playlists
-                self.status.update(changes)
+            if self.cfg["metrics"] and ts >= self.metrics_at:
+                self._dump_metrics(ts)
+
+    def _dump_metrics(self, ts):
+        self.metrics_at = ts + METRICS_INTERVAL
+        try:
+            metrics.dump(self.cfg["metrics"])
+        except (IOError, OSError) as e:
+            _log.warning("couldn't write metrics: %s", e)
 
     def exit(self):
         if self.termbox:
             self.termbox.close()
+        if self.tty:
+            self.tty.close()
         self.mpd.disconnect()
+        if self.cfg["metrics"]:
+            self._dump_metrics(time_in_millis())
 
     def setup(self):
         self.termbox = termbox.Termbox()
+        self.tty = open("/dev/tty")  # Same input as termbox, for select()
         self.msg = Message()
-        self.status = Status(self.mpd, self.msg)
-        self.browser = Browser(self.mpd)
+        self.browser = Browser(self.mpd, self.cfg["lazy"],
+                cache_path(self.cfg["host"], self.cfg["port"]), self.events)
+        self.status = Status(self.mpd, self.msg, self.events)
         self.ui = UI(self.termbox, self.status, self.msg, self.browser)
-        self.connect()
-        self.auth()
-
-        self.browser.load()
-        self.status.init()
+        self.mpd.add_listener(self)
+        self.mpd.connect(self.cfg["password"])
 
         args = [self, self.mpd, self.status, self.ui, self.msg, self.browser]
         self.states = {"playlist": PlaylistState(*args),
@@ -183,27 +238,11 @@ class Main(object):
                 "command": CommandState(*args),
                 "search": SearchState(*args),
                 "find": FindNextState(*args),
-                "help": HelpState(*args)}
+                "help": HelpState(*args),
+                "stats": StatsState(*args)}
         self.change_state("playlist")
 
 
-_stdout = sys.stdout
-_stderr = sys.stderr
-
-
-def redirect_std(path):
-    log_file = open(path, "w")
-    sys.stdout = log_file
-    sys.stderr = log_file
-    return log_file
-
-
-def stop_redirect(log_file):
-    log_file.close()
-    sys.stdout = _stdout
-    sys.stderr = _stderr
-
-
 def usage(cmd):
     print "Usage: %s [OPTIONS]..." % cmd
     print
@@ -211,14 +250,25 @@ def usage(cmd):
             "mandatory for short options too.")
     print
     print "-h, --help       print this message."
+    print "-l, --lazy       load browser directories when visited"
+    print "-L, --log-level  LEVEL[,MODULE=LEVEL]... (debug, info, warning",
+    print "or error), e.g. warning,wrapper=debug (default info)"
+    print "-m, --metrics    write performance counters to this file",
+    print "(every %i s)" % (METRICS_INTERVAL / 1000)
     print "-p, --password   MPD password"
+    print "-t, --timeout    MPD connection timeout in seconds (default %i)" % \
+            CONNECT_TIMEOUT
 
 
 def main(argv=None):
 
     cfg = {"host": "localhost",
             "port": 6600,
-            "password": None
+            "password": None,
+            "lazy": False,
+            "log_levels": (logging.INFO, {}),
+            "metrics": None,
+            "timeout": CONNECT_TIMEOUT
     }
 
     if argv is None:
@@ -227,7 +277,8 @@ def main(argv=None):
     cmd = argv[0]
 
     try:
-        opts, argv = getopt.getopt(argv[1:], "p:h", ["help", "password="])
+        opts, argv = getopt.getopt(argv[1:], "lL:m:p:t:h", ["help", "lazy",
+            "log-level=", "metrics=", "password=", "timeout="])
     except getopt.GetoptError as e:
         print(e)
         usage(cmd)
@@ -237,10 +288,26 @@ def main(argv=None):
         if o in ("-h", "--help"):
             usage(cmd)
             sys.exit()
+        elif o in ("-l", "--lazy"):
+            cfg["lazy"] = True
+        elif o in ("-L", "--log-level"):
+            try:
+                cfg["log_levels"] = log.parse_levels(a)
+            except ValueError:
+                usage(cmd)
+                sys.exit()
+        elif o in ("-m", "--metrics"):
+            cfg["metrics"] = a
         elif o in ("-p", "--password"):
             cfg["password"] = a
+        elif o in ("-t", "--timeout"):
+            try:
+                cfg["timeout"] = float(a)
+            except ValueError:
+                usage(cmd)
+                sys.exit()
 
-    log_file = redirect_std("log")
+    log.start("log", *cfg["log_levels"])
 
     m = Main(cfg)
     try:
@@ -249,12 +316,13 @@ def main(argv=None):
     except SystemExit:
         pass
     except:
+        _log.exception("crashed")
         m.exit()
-        stop_redirect(log_file)
+        log.stop()
         traceback.print_exc()
     finally:
         m.exit()
-        stop_redirect(log_file)
+        log.stop()
 
 if __name__ == "__main__":
     main()
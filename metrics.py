@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Runtime performance counters, shared by the whole program (commands are
+# timed on the MPD thread, everything else on the UI thread).
+
+BOUNDS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]  # ms
+
+
+def ms_since(t):
+    """Returns the milliseconds elapsed since t (as from time.time())."""
+    return (time.time() - t) * 1000
+
+
+class Histogram(object):
+    """Timings in milliseconds, counted in the buckets of BOUNDS (and one
+    for everything slower)."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BOUNDS) + 1)
+
+    def add(self, ms):
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        self.buckets[bisect_left(BOUNDS, ms)] += 1
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket holding the p:th percentile
+        (the maximum if it's in the last one)."""
+        rank = p / 100.0 * self.count
+        n = 0
+        for bound, count in zip(BOUNDS, self.buckets):
+            n += count
+            if n >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def __str__(self):
+        return "%6i %9.1f %8.1f %8.1f %8.1f" % (self.count,
+                self.total / max(self.count, 1), self.percentile(50),
+                self.percentile(95), self.max)
+
+
+class Metrics(object):
+    """Timings (histograms), counters and values by name."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.timings = {}
+        self.counters = {}
+        self.values = {}
+
+    def record(self, name, ms):
+        with self.lock:
+            h = self.timings.get(name)
+            if h == None:
+                h = self.timings[name] = Histogram()
+            h.add(ms)
+
+    @contextmanager
+    def timed(self, name):
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, ms_since(t))
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def report(self):
+        """Returns the metrics as lines of text."""
+        with self.lock:
+            lines = ["Up %i s" % (time.time() - self.started), "",
+                    "%-32s %6s %9s %8s %8s %8s" % ("timing (ms)", "count",
+                        "mean", "p50", "p95", "max")]
+            lines += ["%-32s %s" % (name, h) for name, h in
+                    sorted(self.timings.iteritems())]
+            if self.counters:
+                lines += ["", "%-32s %6s" % ("counter", "count")]
+                lines += ["%-32s %6i" % v for v in
+                        sorted(self.counters.iteritems())]
+            if self.values:
+                lines += ["", "%-32s %6s" % ("value", "")]
+                lines += ["%-32s %6s" % v for v in
+                        sorted(self.values.iteritems())]
+        return lines
+
+    def dump(self, path):
+        """Writes the report to path (replacing it at once, so readers never
+        see half of it)."""
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("".join("%s\n" % l for l in self.report()))
+        os.rename(tmp, path)
+
+
+metrics = Metrics()
@@ -0,0 +1,185 @@
+from collections import OrderedDict
+from re import compile, IGNORECASE
+from string import ascii_uppercase
+from time import time
+
+from index import is_plain
+from metrics import metrics, ms_since
+from worker import Job, Worker
+
+# Search queries (whitespace-separated regexes that all have to match) and a
+# result cache that lets a refined query (e.g. one more character typed)
+# filter the previous results instead of all items.
+
+
+_patterns = {}
+_MAX_PATTERNS = 256
+
+# Items filtered per step of a background search (and the most a search may
+# filter synchronously)
+CHUNK = 2000
+
+# Without re.UNICODE, IGNORECASE only folds ASCII letters
+_ASCII_LOWER = dict((ord(c), ord(c.lower())) for c in ascii_uppercase)
+
+
+def fold(s):
+    """Lower-cases s the way IGNORECASE does (ASCII letters only)."""
+    return unicode(s).translate(_ASCII_LOWER)
+
+
+def pattern(term):
+    r = _patterns.get(term)
+    if r == None:
+        if len(_patterns) >= _MAX_PATTERNS:
+            _patterns.clear()
+        r = _patterns[term] = compile(term, IGNORECASE)
+    return r
+
+
+def scan(query, items):
+    """Returns the items (songs) matching query."""
+    return [v for v in items if query.matches(v)]
+
+
+class Query(object):
+
+    def __init__(self, s):
+        self.string = s
+        self.terms = s.split()
+        self.regexes = [pattern(t) for t in self.terms]
+
+    def matches(self, song):
+        return song.matches_all(self.regexes)
+
+    def _implies(self, term, other):
+        if term == other:
+            return True
+        return (is_plain(term) and is_plain(other) and
+                fold(other) in fold(term))
+
+    def refines(self, other):
+        """Returns True if everything matching this query also matches
+        other."""
+        return all(any(self._implies(t, o) for t in self.terms)
+                for o in other.terms)
+
+
+class SearchJob(Job):
+    """A running search. items grows as results are delivered (always on the
+    thread owning the event queue), done is set once it's complete."""
+
+    def __init__(self, s, key, query, progress=None):
+        super(SearchJob, self).__init__()
+        self.string = s
+        self.key = key
+        self.query = query
+        self.progress = progress
+        self.items = []
+
+    def run(self, source, scan, events):
+        """Filters source in chunks, posting each chunk's matches."""
+        query = self.query
+        chunk = []
+        for v in source:
+            if len(chunk) == CHUNK:
+                if self.cancelled:
+                    return
+                events.post(self._deliver, scan(query, chunk), False)
+                chunk = []
+            chunk.append(v)
+        if not self.cancelled:
+            events.post(self._deliver, scan(query, chunk), True)
+
+    def _deliver(self, items, done):
+        if not self.cancelled:
+            self.items.extend(items)
+            self.done = done
+            if self.progress:
+                self.progress(self)
+
+
+class Filter(object):
+
+    def __init__(self, scan=scan, size=16, events=None, name="search"):
+        self.scan = scan
+        self.size = size
+        self.events = events
+        self.name = name  # Under which search times are recorded
+        self.worker = None
+        self.key = None
+        self.results = OrderedDict()
+
+    def clear(self):
+        self.key = None
+        self.results.clear()
+
+    def _base(self, query):
+        """Returns the smallest cached result that query refines."""
+        base = None
+        for q, items in self.results.itervalues():
+            if query.refines(q) and (base == None or len(items) < len(base)):
+                base = items
+        return base
+
+    def _store(self, job):
+        if job.key == self.key:
+            self.results.pop(job.string, None)
+            self.results[job.string] = (job.query, job.items)
+            if len(self.results) > self.size:
+                self.results.popitem(last=False)
+
+    def covers(self, s, key):
+        """Returns True if the items matching s can be found from the cached
+        results alone, without the pool."""
+        return key == self.key and (s in self.results or
+                self._base(Query(s)) != None)
+
+    def run(self, s, key, pool):
+        """Returns the items matching s. key identifies the item set (cached
+        results are dropped when it changes) and pool(query) returns the
+        items to filter if no cached result can be narrowed down."""
+        job = self.start(s, key, pool, None, False)
+        return job.items
+
+    def start(self, s, key, pool, progress=None, background=True):
+        """Like run(), but returns a SearchJob. Unless the result is cached or
+        can be narrowed down from a small cached result, the search runs on
+        a worker thread and progress(job) is called as results arrive."""
+        if key != self.key:
+            self.results.clear()
+            self.key = key
+
+        if s in self.results:
+            query, items = self.results[s]
+            job = SearchJob(s, key, query)
+            job.items, job.done = items, True
+            self._store(job)
+            return job
+
+        t = time()
+        query = Query(s)
+        base = self._base(query)
+        background = (background and self.events != None and
+                (base == None or len(base) > CHUNK))
+
+        def finish(job):
+            if job.done:
+                metrics.record(self.name, ms_since(t))
+                self._store(job)
+            if progress:
+                progress(job)
+
+        job = SearchJob(s, key, query, finish)
+        if background:
+            if self.worker == None:
+                self.worker = Worker("search")
+            self.worker.submit(lambda: job.run(pool(query) if base == None
+                else base, self.scan, self.events))
+        else:
+            job.items = self.scan(query, pool(query) if base == None
+                    else base)
+            job.done = True
+            metrics.record(self.name, ms_since(t))
+            self._store(job)
+        return job
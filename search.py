@@ -39,7 +39,7 @@ class PlaylistSearch(Search, ListListener):
             self.playlist.search(self.buf or None)
 
     def _update(self):
-        self.found = len(self.playlist) > 0
+        self.found = len(self.playlist) > 0 or self.playlist.searching()
         self.notify("search_changed")
 
     def list_changed(self, unused):
@@ -65,7 +65,8 @@ class BrowserSearch(Search, BrowserListener):
             self.browser.search(self.buf or None)
 
     def _update(self):
-        self.found = len(self.browser.curr_node) > 0
+        self.found = (len(self.browser.curr_node) > 0 or
+                self.browser.searching())
         self.notify("search_changed")
 
     def browser_node_changed(self, browser):
@@ -106,6 +107,7 @@ class SearchUI(Component):
     def _update(self):
         line = "/" + self.search.buf
         self.lines = [line[i:i + self.w] for i in range(0, len(line), self.w)]
+        self.invalidate()
         self.fix_height()
         self.fix_cursor()
 
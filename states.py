@@ -3,6 +3,7 @@
 from command import *
 from commands import *
 from components import *
+from metrics import metrics
 from search import *
 from status import *
 from ui import *
@@ -195,6 +196,17 @@ class CommandState(State):
         def execute(self):
             self.state.commandline.remove_last()
 
+    class ShowCommand(Command):
+        """Switches to another state once the command line is closed."""
+
+        def __init__(self, state, name, description, new_state):
+            super(CommandState.ShowCommand, self).__init__(name, description)
+            self.state = state
+            self.new_state = new_state
+
+        def execute(self, *unused_args):
+            self.state.next_state = self.new_state
+
     def _setup_commands(self):
         res = ResourceTuple(self.mpd, self.status, self.ui, self.browser)
 
@@ -202,6 +214,7 @@ class CommandState(State):
                 "clear": PlaylistClearCommand(res),
                 "consume": boolean_option_command(res, "consume"),
                 "crossfade": CrossfadeOptionCommand(res),
+                "current": PlaylistGoToCurrentCommand(res),
                 "next": NextCommand(res),
                 "playpause": ToggleCommand(res),
                 "previous": PrevCommand(res),
@@ -212,6 +225,8 @@ class CommandState(State):
                 "repeat": boolean_option_command(res, "repeat"),
                 "seek": SeekCurCommand(res),
                 "single": boolean_option_command(res, "single"),
+                "stats": self.ShowCommand(self, "stats",
+                    "Show performance counters", "stats"),
                 "stop": StopCommand(res),
                 "update": BrowserUpdateCommand(res)
         }
@@ -235,8 +250,11 @@ class CommandState(State):
         self.ui.command.hide()
         self.ui.command.fix_cursor()
         self.listener.prev_state()
+        if s:
+            self.listener.change_state(s, d)
 
     def execute(self):
+        self.next_state = None
         try:
             self.commandline.execute()
         except UnknownCommandException, err:
@@ -249,7 +267,7 @@ class CommandState(State):
         except CommandExecutionError, err:
             self.msg.error(unicode(err), 2)
 
-        self.deactivate()
+        self.deactivate(self.next_state)
 
     def key_event(self, ch, key, unused_mod):
         t = self.bindings.get(ch, key)
@@ -393,3 +411,11 @@ class HelpState(State):
 
     def deactivate(self, s=None, d={}):
         self.listener.prev_state()
+
+
+class StatsState(HelpState):
+
+    def activate(self, args={}):
+        self.ui.stats.set_text(metrics.report())
+        self.ui.set_main(self.ui.stats)
+        self.ui.show_top(None)
@@ -1,64 +1,255 @@
+from itertools import chain
 from re import compile, IGNORECASE
 
 from browser import *
 from common import *
+from index import is_plain
 from list import *
+from metrics import metrics, ms_since
+from query import Filter
+from worker import Job
 from wrapper import *
+import logging
+import time
 import traceback
 
+_log = logging.getLogger(__name__)
+
+# Queues longer than this are not loaded as a whole, only the pages around
+# what's shown are
+WINDOW_LENGTH = 50000
+PAGE_SIZE = 256
+PAGE_CACHE = 64  # Pages kept
+READ_AHEAD = 2  # Pages fetched before and after the visible ones
+# Songs a queue may grow by and still be synced in a single round trip
+GROWTH = 1024
+
+
+# A queue too long to load: its songs are fetched a page at a time
+class Window(object):
+
+    def __init__(self, mpd, length, version, loaded):
+        self.mpd = mpd
+        self.length = length
+        self.version = version
+        self.loaded = loaded
+        self.pages = LRUCache(PAGE_CACHE)  # Page -> (version, songs)
+        self.pending = set()  # Pages being fetched
+
+    def __len__(self):
+        return self.length
+
+    # None if not loaded yet (the song is fetched then)
+    def __getitem__(self, pos):
+        if not 0 <= pos < self.length:
+            raise IndexError(pos)
+        song = self.peek(pos)
+        if song == None or self.pages.get(pos / PAGE_SIZE)[0] != self.version:
+            self.show(pos, pos + 1)
+        return song
+
+    def peek(self, pos):
+        page = self.pages.get(pos / PAGE_SIZE)
+        if page != None and pos % PAGE_SIZE < len(page[1]):
+            return page[1][pos % PAGE_SIZE]
+        return None
+
+    def show(self, start, end):
+        first = max(0, start / PAGE_SIZE - READ_AHEAD)
+        last = min((self.length - 1) / PAGE_SIZE, (end - 1) / PAGE_SIZE +
+                READ_AHEAD)
+        run = []
+        for p in xrange(first, last + 1):
+            page = self.pages.get(p)
+            if not p in self.pending and (page == None or
+                    page[0] != self.version):
+                run.append(p)
+            elif run:
+                self._fetch(run)
+                run = []
+        if run:
+            self._fetch(run)
+
+    def _fetch(self, pages):
+        start, end = pages[0] * PAGE_SIZE, (pages[-1] + 1) * PAGE_SIZE
+        version = self.version
+        self.pending.update(pages)
+        self.mpd.submit(lambda: self.mpd.playlistinfo(start, end),
+                lambda entries: self._fetched(pages, version, entries))
+
+    def _fetched(self, pages, version, entries):
+        self.pending.difference_update(pages)
+        songs = [self.mpd.songs.song(d) for d in entries]
+        for p in pages:
+            i = (p - pages[0]) * PAGE_SIZE
+            self.pages.put(p, (version, songs[i:i + PAGE_SIZE]))
+        self.loaded()
+
+    def resize(self, length, version):
+        self.length = length
+        self.version = version
+        self.pending.clear()
+
+    # Results of fetches in flight never arrive after a lost connection
+    def retry(self):
+        self.pending.clear()
+        self.loaded()
+
+    # Runs on the I/O thread. MPD's matches for plain terms are a superset
+    def search(self, s):
+        args = []
+        for t in s.split():
+            if is_plain(t):
+                args += ["any", t]
+        if not args:
+            return self.mpd.playlistinfo(0, self.length)
+        return self.mpd.playlistsearch(*args)
+
 
 class Playlist(List):
 
-    def __init__(self, mpd):
+    def __init__(self, mpd, events=None):
         super(Playlist, self).__init__()
         self.mpd = mpd
         self.version = 0
         self.playtime = 0
+        self.by_id = {}  # Song id -> song, for all songs (not just matches)
+        self.total_time = 0  # Sum of the time of all songs
+        self.filter = Filter(mpd.songs.scan, events=events,
+                name="playlist filter")
+        self.search_job = None
+        self.window = None  # The Window of a queue too long to load
 
     def find_next(self, reg):
         rl = compile(reg, IGNORECASE)
-        # TODO beautify
-        for i in range(self.sel + 1, len(self)) + range(0, self.sel):
-            if rl.search(unicode(self[i])):
+        get = self.window.peek if self.items is self.window else \
+                self.items.__getitem__
+        for i in chain(xrange(self.sel + 1, len(self)), xrange(0, self.sel)):
+            song = get(i)
+            if song != None and rl.search(unicode(song)):
                 return i
         return -1
 
-    def init(self, _songs, version):
-        self.version = version
-        self.set_list(map(lambda d: Song(d), _songs))
+    def index_of(self, song):
+        if self.items is self.real_items:
+            return song.pos if 0 <= song.pos < len(self) else -1
+        for i, v in enumerate(self.items):
+            if v.songid == song.songid:
+                return i
+        return -1
 
-    def _handle_set(self):
-        self.playtime = 0
-        for v in self.items:
-            self.playtime += v.time
+    def show(self, start, end):
+        if self.items is self.window:
+            self.window.show(start, end)
+
+    def set_window(self, length, version):
+        if self.window == None:
+            self.filter.clear()
+            self.by_id = {}
+            self.total_time = 0
+            self.window = Window(self.mpd, length, version,
+                    self._window_loaded)
+        else:
+            self.window.resize(length, version)
+        self.version = version
+        self.set_list(self.window)
 
-    def update(self, changelist, version, real_len):
-        lookup = {}
+    def _window_loaded(self):
+        if self.items is self.window:
+            self.notify("list_changed", self)
 
-        for s in self.real_items:
-            lookup[s.songid] = s
+    def resume(self):
+        if self.window != None:
+            self.window.retry()
+            if self.searching():
+                self.set_list(self.window)
 
-        if len(changelist) > 0:
-            del self.real_items[int(changelist[0]["cpos"]):]
+    def init(self, _songs, version):
+        self.filter.clear()
+        self.window = None
+        self.version = version
+        songs = [self._song(d, {}) for d in _songs]
+        self.by_id = dict((s.songid, s) for s in songs)
+        self.total_time = sum(s.time for s in songs)
+        self.set_list(songs)
 
-        for s in changelist:
-            sid = int(s["id"])
-            if sid in lookup:
-                song = lookup[sid]
-                song.pos = int(s["cpos"])  # Update song pos to correct one
-                self.real_items.append(song)
+    def _handle_set(self):
+        if self.items is self.real_items:
+            self.playtime = self.total_time
+        else:
+            self.playtime = sum(v.time for v in self.items)
+
+    def _song(self, d, lookup):
+        song = lookup.get(int(d.get("id", -1)))
+        if song != None and song.file == d.get("file"):
+            song.pos = int(d.get("pos", -1))  # Update song pos to correct one
+            return song
+        return self.mpd.songs.song(d)
+
+    # plchanges only lists the positions that changed
+    def update(self, changelist, version, real_len):
+        items = self.real_items
+        old = [items[int(d["pos"])] for d in changelist
+                if int(d["pos"]) < len(items)] + items[real_len:]
+        removed = {}
+        for s in old:
+            removed[s.songid] = s
+            self.by_id.pop(s.songid, None)
+            self.total_time -= s.time
+        del items[real_len:]
+
+        for d in changelist:
+            song = self._song(d, removed)
+            self.by_id[song.songid] = song
+            self.total_time += song.time
+            if song.pos < len(items):
+                items[song.pos] = song
             else:
-                self.real_items.append(self.mpd.playlist_song(sid))
-
-        # Detect songs removed from the back of the list
-        if real_len < len(self):
-            del self.real_items[(real_len - len(self)):]
+                items.append(song)
         self.version = version
-        self.set_list(self.real_items)
+        self.set_list(items)
+
+    def _cancel_search(self):
+        if self.search_job:
+            self.search_job.cancel()
+            self.search_job = None
 
     def _search(self):
-        rl = map(lambda s: compile(s, IGNORECASE), self.search_string.split())
-        return filter(lambda s: s.matches_all(rl), self.real_items)
+        self._cancel_search()
+        s, version = self.search_string, self.version
+        if self.window == None or self.filter.covers(s, version):
+            self.search_job = self.filter.start(s, version,
+                    lambda unused_query: self.real_items,
+                    self._search_progress)
+            return self.search_job.items
+
+        # The candidates of a windowed queue are fetched first
+        job = self.search_job = Job()
+        window = self.window
+        self.mpd.submit(lambda: window.search(s),
+                lambda entries: self._search_fetched(job, s, entries))
+        return []
+
+    def _search_fetched(self, job, s, entries):
+        if job is self.search_job:
+            songs = [self.mpd.songs.song(d) for d in entries]
+            self.search_job = self.filter.start(s, self.version,
+                    lambda unused_query: songs, self._search_progress)
+            self.items = self.search_job.items
+            self._search_progress(self.search_job)
+
+    def _search_progress(self, job):
+        if job is self.search_job:
+            self._fix_sel()
+            self._handle_set()
+            self.notify("list_changed", self)
+
+    def _search_stop(self):
+        self._cancel_search()
+        super(Playlist, self)._search_stop()
+
+    def searching(self):
+        return self.search_job != None and not self.search_job.done
 
 
 class Progress(object):
@@ -98,12 +289,33 @@ def _get_int(d, v, de=0):
     return int(d.get(v, de))
 
 
+# What has to be fetched when a subsystem has changed (the others, e.g.
+# mixer and output, aren't shown)
+_SYNC = {"playlist": ("status", "plchanges", "currentsong"),
+        "player": ("status", "currentsong"),
+        "options": ("status", )}
+
+
+def sync_plan(changes):
+    needed = set()
+    for c in changes:
+        needed.update(_SYNC.get(c, ()))
+    return [c for c in ("status", "plchanges", "currentsong") if c in needed]
+
+
+# Runs on the I/O thread, None if the queue is windowed
+def _plchanges(mpd, results, since):
+    if _get_int(results, "playlistlength") > WINDOW_LENGTH:
+        return None
+    return mpd.plchanges(since)
+
+
 class Status:
 
-    def __init__(self, mpd, msg):
+    def __init__(self, mpd, msg, events=None):
         self.mpd = mpd
         self.msg = msg
-        self.playlist = Playlist(mpd)
+        self.playlist = Playlist(mpd, events)
         self.progress = Progress()
         self.options = {
                 "consume": False,
@@ -115,9 +327,10 @@ class Status:
         self.current = None
         self.state = ""
         self.listeners = []
+        self.ranged = True  # Whether MPD takes a range for plchanges
 
-    def _set_current(self, pos):
-        self.current = self.mpd.current_song()
+    def _set_current(self, d):
+        self.current = self.mpd.songs.song(d) if d else None
         self.progress.total_time = self.current.time if self.current else 0
 
         for o in self.listeners:
@@ -132,9 +345,6 @@ class Status:
             for o in self.listeners:
                 o.option_changed(opt, b)
 
-    def _set_playlist(self, songs, version):
-        self.playlist.init(songs, version)
-
     def _set_state(self, state):
         if self.state != state:
             self.state = state
@@ -145,14 +355,30 @@ class Status:
         self.listeners.append(o)
 
     def init(self):
-        results = self.mpd.status()
-        print(results)
+        mpd = self.mpd
+
+        def fetch():
+            results, current = mpd.command_list(("status", ),
+                    ("currentsong", ))
+            return results, _plchanges(mpd, results, 0), current
+        mpd.submit(fetch, self._synced(self._init))
+
+    def _synced(self, func):
+        t = time.time()
+
+        def done(results):
+            func(*results)
+            metrics.record("status sync", ms_since(t))
+        return done
+
+    def _init(self, results, changelist, current):
+        _log.debug("status: %s", results)
         if not results:
             self.msg.error("Couldn't retrieve MPD status", 1)
             return
-        self._set_playlist(self.mpd.plchanges(0), int(results["playlist"]))
+        self._update_playlist(results, 0, changelist)
         self._set_state(results.get("state", "unknown"))
-        self._set_current(int(results.get("song", -1)))
+        self._set_current(current)
         self._set_elapsed(elapsed_sec(results))
         self._update_options(results)
 
@@ -163,11 +389,20 @@ class Status:
         self._set_option("single", _get_bool(results, "single"))
         self._set_option("xfade", _get_int(results, "xfade", -1))
 
-    def _update_playlist(self, results):
-        changelist = self.mpd.plchangesposid(self.playlist.version)
+    def _update_playlist(self, results, since, changelist):
         real_len = int(results["playlistlength"])
         version = int(results["playlist"])
-        self.playlist.update(changelist, version, real_len)
+        if since != 0 and changelist != None and self.playlist.window != None:
+            self.update(["playlist"])  # Windowed meanwhile, fetch it all
+            return
+        with metrics.timed("playlist sync"):
+            if changelist == None:
+                self.playlist.set_window(real_len, version)
+            elif since == 0:
+                self.playlist.init(changelist, version)
+            else:
+                self.playlist.update(changelist, version, real_len)
+        metrics.set("playlist length", real_len)
 
     def _update_player(self, results):
         # Update state
@@ -179,39 +414,83 @@ class Status:
 
         return curr_id != prev_id
 
+    # Everything needed is fetched with one command list (one round trip)
     def update(self, changes):
-        if len(changes) == 0:
+        plan = sync_plan(changes)
+        if not plan:
             return
 
-        results = self.mpd.status()
-
+        mpd = self.mpd
+        version = self.playlist.version
+        windowed = self.playlist.window != None
+        # A windowed queue that got short enough is loaded as a whole
+        since = 0 if windowed else version
+        playlist = "plchanges" in plan
+        if playlist and (windowed or not self.ranged):
+            plan.remove("plchanges")
+        # Only the changes at the positions the queue is expected to have
+        # are fetched along with the status, so a queue that has grown a lot
+        # (perhaps too long to be loaded) isn't downloaded before that's
+        # known
+        limit = min(len(self.playlist.real_items) + GROWTH, WINDOW_LENGTH)
+        commands = [(c, version, "0:%i" % limit) if c == "plchanges" else
+                (c, ) for c in plan]
+
+        def fetch():
+            try:
+                values = mpd.command_list(*commands)
+            except CommandError:
+                if not "plchanges" in plan:
+                    raise
+                # No ranges (older MPD), the changes are fetched after the
+                # status, once the queue is known to be short enough
+                self.ranged = False
+                plan.remove("plchanges")
+                values = mpd.command_list(*[(c, ) for c in plan])
+            fetched = dict(zip(plan, values))
+            results = fetched["status"]
+            changed = playlist and int(results["playlist"]) != version
+            changelist = fetched.get("plchanges")
+            if changed and (changelist == None or
+                    _get_int(results, "playlistlength") > limit):
+                changelist = _plchanges(mpd, results, since)
+            return results, changed, changelist, fetched.get("currentsong")
+        mpd.submit(fetch, self._synced(lambda *results:
+            self._update(changes, since, *results)))
+
+    def resume(self):
+        self.playlist.resume()
+        self.update(["player", "playlist", "options"])
+
+    def _update(self, changes, since, results, changed, changelist,
+            current):
         if not results:
             self.msg.error("Couldn't retrieve MPD status", 1)
             return
         update_current = False
-        print(results)
+        _log.debug("status: %s (%s changed)", results, changes)
 
-        self._set_elapsed(int(results.get("elapsed", "0").split(".")[0]))
+        self._set_elapsed(elapsed_sec(results))
 
-        if "playlist" in changes:
-            self._update_playlist(results)
+        if changed:
+            self._update_playlist(results, since, changelist)
             update_current = True
 
         if "player" in changes:
             update_current = self._update_player(results) or update_current
 
         if update_current:
-            self._set_current(int(results.get("song", -1)))
+            self._set_current(current)
 
         if "options" in changes:
             self._update_options(results)
 
         if "output" in changes:
-            print(":: updating output")
+            _log.debug("updating output")
             # TODO
 
         if "stored_playlist" in changes:
-            print(":: updating stored_playlist")
+            _log.debug("updating stored_playlist")
             # TODO
 
     def is_playing(self):
@@ -1,58 +1,122 @@
+import logging
 import sys
 import termbox
 
+_log = logging.getLogger(__name__)
 
-def _cl(s, fg, bg):
-    return [[fg, bg] for x in xrange(len(s))]
 
-
-def _replace_color(colors, new, pos):
-    return colors[0:pos] + new + colors[pos + len(new):]
+def _uncovered(start, end, spans):
+    """Yields the parts of [start, end) not covered by any of the spans."""
+    for x, x_end in sorted(spans):
+        if x > start:
+            yield start, min(x, end)
+        start = max(start, x_end)
+        if start >= end:
+            return
+    yield start, end
 
 
 class Format:
+    """A string and its colors, stored as runs of [end, fg, bg] (each run
+    covers the characters from the previous run's end up to its own)."""
 
     def __init__(self, s="", fg=termbox.WHITE, bg=termbox.BLACK):
         self.s = s
-        self.colors = _cl(s, fg, bg)
+        self.runs = [[len(s), fg, bg]] if s else []
 
     def add(self, ns, fg, bg):
+        if not ns:
+            return
         self.s += ns
-        self.colors += _cl(ns, fg, bg)
+        last = self.runs[-1] if self.runs else None
+        if last and last[1] == fg and last[2] == bg:
+            last[0] = len(self.s)
+        else:
+            self.runs.append([len(self.s), fg, bg])
+
+    def pad(self, w, fg, bg):
+        """Adds spaces until the string is w characters wide."""
+        if w > len(self.s):
+            self.add(u" " * (w - len(self.s)), fg, bg)
+
+    def _split(self, pos):
+        """Makes a run end at pos, returns the index of the run after it."""
+        for i, run in enumerate(self.runs):
+            if run[0] == pos:
+                return i + 1
+            elif run[0] > pos:
+                self.runs.insert(i, [pos, run[1], run[2]])
+                return i + 1
+        return len(self.runs)
 
     def replace(self, pos, ns, fg, bg):
         if pos > len(self.s):
-            self.add("".ljust(pos - len(self.s)), *self.colors[-1])
+            self.pad(pos, *self.style(len(self.s) - 1))
             self.add(ns, fg, bg)
-        else:
-            self.s = self.s[0:pos] + ns + self.s[pos + len(ns):]
-            self.colors = _replace_color(self.colors, _cl(ns, fg, bg), pos)
+        elif ns:
+            end = pos + len(ns)
+            i = self._split(pos)
+            j = self._split(min(end, len(self.s)))
+            self.s = self.s[0:pos] + ns + self.s[end:]
+            self.runs[i:j] = [[end, fg, bg]]
+
+    def style(self, pos):
+        """Returns the (fg, bg) of the character at pos."""
+        for end, fg, bg in self.runs:
+            if pos < end:
+                return fg, bg
+        return termbox.WHITE, termbox.BLACK
 
     def set_bold(self):
-        for v in self.colors:
-            v[0] |= termbox.BOLD
+        for run in self.runs:
+            run[1] |= termbox.BOLD
 
     def set_color(self, fg, bg):
-        self.colors = _cl(self.s, fg, bg)
+        self.runs = [[len(self.s), fg, bg]] if self.s else []
+
+
+def cell_writer(tb):
+    """Returns change_cells(x, y, s, fg, bg), which writes the string s as a
+    row of equally colored cells. Uses the termbox binding's bulk call if it
+    has one and falls back to one change_cell() call per character."""
+    change_cells = getattr(tb, "change_cells", None)
+    if change_cells != None:
+        return change_cells
+    change_cell = tb.change_cell
+
+    def change_cells(x, y, s, fg, bg):
+        for i, c in enumerate(map(ord, s)):
+            change_cell(x + i, y, c, fg, bg)
+    return change_cells
 
 
 class Drawable(object):
 
     def __init__(self, tb, x=0, y=0, w=1, h=1):
         self.tb = tb
+        self.change_cells = cell_writer(tb)
         self.x, self.y, self.w, self.h = x, y, w, h
 
     def change_cells_format(self, ix, y, format, w=-1, pad=u" "):
-        fg, bg = termbox.WHITE, termbox.BLACK
+        """Draws format at (ix, y), padded with pad (in the color of the last
+        character) to w characters. Each run of equally colored characters
+        is written with one change_cells() call, clipped to the screen."""
+        y += self.y
+        if y < 0:
+            return
         ix += self.x
-
-        for x, c in enumerate(format.s):
-            fg, bg = format.colors[x]
-            if self.x + x >= 0 and self.y + y >= 0:
-                self.tb.change_cell(ix + x, self.y + y, ord(c), fg, bg)
-        for x in xrange(ix + len(format.s), ix + max(w, len(format.s))):
-            if self.x + x >= 0 and self.y + y >= 0:
-                self.tb.change_cell(self.x + x, self.y + y, ord(pad), fg, bg)
+        s = format.s
+        limit = min(max(w, len(s)), self.tb.width() - ix)
+        x = max(0, -ix)
+        fg, bg = termbox.WHITE, termbox.BLACK
+        for end, fg, bg in format.runs:
+            if x < min(end, limit):
+                self.change_cells(ix + x, y, s[x:min(end, limit)], fg, bg)
+            if end >= limit:
+                return
+            x = max(x, end)
+        if x < limit:
+            self.change_cells(ix + x, y, pad * (limit - x), fg, bg)
 
     def draw(self):
         pass
@@ -64,13 +128,13 @@ class Drawable(object):
 class ComponentListener(object):
 
     def dim_changed(self, o):
-        print ("%s: dim_changed: %i %i %i %i" % (str(o), o.x, o.y, o.w, o.h))
+        _log.debug("%s: dim_changed: %i %i %i %i", o, o.x, o.y, o.w, o.h)
 
     def preferred_dim_changed(self, o):
-        print ("%s: preferred_dim_changed: %i %i" % (str(o), o.prefw, o.prefh))
+        _log.debug("%s: preferred_dim_changed: %i %i", o, o.prefw, o.prefh)
 
     def visibility_changed(self, o):
-        print ("%s: visibility_changed: %r" % (str(o), o.visible))
+        _log.debug("%s: visibility_changed: %r", o, o.visible)
 
 
 class Component(Drawable):
@@ -80,10 +144,62 @@ class Component(Drawable):
         self.listeners = []
         self.visible = True
         self.prefw, self.prefh = -1, -1
+        self.dirty = True
+        self.dirty_rows = set()
+        self.opaque = False  # Draws every row with change_row_formats()
+        self.extents = {}
 
     def _handle_resize(self):
         pass
 
+    def clear_area(self):
+        for y in xrange(self.h):
+            self.change_cells_format(0, y, Format(), self.w)
+        self.extents = dict.fromkeys(xrange(self.h), ())
+
+    def change_row_formats(self, y, parts):
+        """Draws the (x, format) parts on row y and blanks whatever else was
+        drawn on the row before, so rows can be redrawn without clearing."""
+        spans = [(x, x + len(f.s)) for x, f in parts]
+        for start, end in self.extents.get(y, [(0, self.w)]):
+            for bx, bx_end in _uncovered(start, end, spans):
+                self.change_cells_format(bx, y, Format(), bx_end - bx)
+        for x, f in parts:
+            self.change_cells_format(x, y, f)
+        self.extents[y] = spans
+
+    def draw_rows(self, rows):
+        """Redraws only the given rows (components that can't do that just
+        redraw everything)."""
+        self.clear_area()
+        self.draw()
+
+    def invalidate(self, rows=None):
+        """Marks the component (or only the given rows) as needing a
+        redraw."""
+        if rows == None:
+            self.dirty = True
+        else:
+            self.dirty_rows.update(y for y in rows if 0 <= y < self.h)
+
+    def is_dirty(self):
+        return self.dirty or len(self.dirty_rows) > 0
+
+    def redraw(self, cleared=False):
+        """Draws whatever needs it: the given rows only if just those were
+        invalidated, otherwise (e.g. when is_dirty() is overridden) all of
+        the component."""
+        if self.dirty_rows and not self.dirty:
+            self.draw_rows(sorted(self.dirty_rows))
+        elif self.is_dirty():
+            if cleared:
+                self.extents = dict.fromkeys(xrange(self.h), ())
+            elif not self.opaque:
+                self.clear_area()
+            self.draw()
+        self.dirty = False
+        self.dirty_rows = set()
+
     def add_listener(self, o):
         if not o in self.listeners:
             self.listeners.append(o)
@@ -100,6 +216,8 @@ class Component(Drawable):
         if set_stored:
             self.stored_dim = [x, y, w, h]
         if self.visible:
+            if [self.x, self.y, self.w, self.h] != [x, y, w, h]:
+                self.invalidate()
             self.x, self.y, self.w, self.h = x, y, w, h
             if notify:
                 self.notify("dim_changed")
@@ -152,16 +270,24 @@ class VerticalLayout(Component, ComponentListener):
         self.bottom_strut = 0
 
     def draw(self):
-        self.tb.clear()
-        if self.main:
-            self.main.draw()
-        for c in self.top:
-            if c.visible:
-                c.draw()
-        for c in self.bottom:
-            if c.visible:
-                c.draw()
-        self.tb.present()
+        """Redraws the dirty components, or everything (after clearing the
+        screen) if the layout has changed. Returns True if anything was
+        drawn."""
+        cleared = self.dirty
+        if cleared:
+            self.tb.clear()
+
+        drawn = cleared
+        for c in [self.main] + self.top + self.bottom:
+            if c and c.visible and (cleared or c.is_dirty()):
+                if cleared:
+                    c.invalidate()
+                c.redraw(cleared)
+                drawn = True
+        self.dirty = False
+        if drawn:
+            self.tb.present()
+        return drawn
 
     def add_top(self, c):
         c.add_listener(self)
@@ -218,6 +344,7 @@ class VerticalLayout(Component, ComponentListener):
         self.fix_top()
         self.fix_bottom()
         self.fix_main()
+        self.invalidate()
 
     def set_size(self, w, h):
         self.w = w
@@ -226,18 +353,18 @@ class VerticalLayout(Component, ComponentListener):
 
     def dim_changed(self, o):
         if not (o in self.top or o in self.bottom or o == self.main):
-            print("unknown " + str(o))
+            _log.error("unknown component %s", o)
             sys.exit(0)
         self.fix()
 
     def preferred_dim_changed(self, o):
         if not (o in self.top or o in self.bottom or o == self.main):
-            print("unknown " + str(o))
+            _log.error("unknown component %s", o)
             sys.exit(0)
         self.fix()
 
     def visibility_changed(self, o):
         if not (o in self.top or o in self.bottom or o == self.main):
-            print("unknown " + str(o))
+            _log.error("unknown component %s", o)
             sys.exit(0)
         self.fix()
@@ -0,0 +1,109 @@
+import errno
+import fcntl
+import logging
+import os
+import select
+import threading
+from collections import deque
+
+# Minimal message passing between the UI thread and background threads.
+# Work is handed over as callables; an EventQueue has a pipe that is
+# readable while something is queued so it can be select()ed on.
+
+_log = logging.getLogger(__name__)
+
+
+def _set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) |
+            os.O_NONBLOCK)
+
+
+class EventQueue(object):
+
+    def __init__(self):
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.rfd, self.wfd = os.pipe()
+        _set_nonblocking(self.rfd)
+        _set_nonblocking(self.wfd)
+
+    def fileno(self):
+        return self.rfd
+
+    def pending(self):
+        return len(self.queue) > 0
+
+    def post(self, func, *args):
+        with self.lock:
+            self.queue.append((func, args))
+        try:
+            os.write(self.wfd, "x")
+        except OSError as e:  # Pipe full, the reader is already woken up
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _drain(self):
+        try:
+            while os.read(self.rfd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def dispatch(self):
+        """Runs everything queued so far (in the calling thread)."""
+        self._drain()
+        while True:
+            with self.lock:
+                if not self.queue:
+                    return
+                func, args = self.queue.popleft()
+            func(*args)
+
+    def wait(self, timeout=None):
+        try:
+            select.select([self.rfd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+
+class Job(object):
+
+    def __init__(self):
+        self.cancelled = False
+        self.done = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Worker(threading.Thread):
+    """Daemon thread running the callables submitted to it, in order."""
+
+    def __init__(self, name):
+        super(Worker, self).__init__(name=name)
+        self.daemon = True
+        self.inbox = EventQueue()
+
+    def submit(self, func, *args):
+        if not self.is_alive():
+            self.start()
+        self.inbox.post(func, *args)
+
+    def wait(self):
+        """Blocks until something is submitted (subclasses may wait for
+        more than that)."""
+        self.inbox.wait()
+
+    def run(self):
+        while True:
+            self.wait()
+            # Dispatched even if nothing is pending, which empties the pipe
+            # (its wakeup may arrive after the job has already been run)
+            while True:
+                try:
+                    self.inbox.dispatch()
+                    break
+                except:
+                    _log.exception("%s: job failed", self.name)
@@ -1,44 +1,238 @@
+import errno
+import logging
 import re
+import select
+import time
 
-from mpd import (MPDClient, CommandError)
-from socket import error as SocketError
+from array import array
+from itertools import compress
+
+from mpd import (MPDClient, CommandError, ConnectionError)
+from socket import (AF_INET, AF_INET6, IPPROTO_TCP, TCP_NODELAY,
+        error as SocketError)
+
+from common import Backoff, Listenable
+from index import is_plain
+from metrics import metrics, ms_since
+from query import CHUNK, fold
+from worker import Worker
+
+try:
+    import numpy
+except ImportError:  # Optional, only used to speed up searches
+    numpy = None
+
+
+CONNECT_TIMEOUT = 5  # Seconds
+RECONNECT_FIRST = 1
+RECONNECT_LIMIT = 60
+KEEPALIVE = 30  # MPD closes connections idle for longer than a minute
+
+_log = logging.getLogger(__name__)
 
 
 def unknown_command_error(e, cmd):
     return str(e) == "[5@0] {} unknown command \"%s\"" % cmd
 
 
+def _close(client):
+    try:
+        client.disconnect()
+    except (SocketError, ConnectionError):
+        pass
+
+
+# The timeout only applies to connecting (legacy python-mpd has none)
+def _open(client, host, port, timeout):
+    if hasattr(client, "timeout"):  # python-mpd2
+        client.timeout = timeout
+        client.connect(host, port)
+        client.timeout = None
+    else:
+        client.connect(host, port)
+
+
+# Command lists are written a line at a time, Nagle would delay each line
+def _nodelay(client):
+    sock = getattr(client, "_sock", None)
+    if sock != None and sock.family in (AF_INET, AF_INET6):
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+
+
 def elapsed_sec(s):
     return int(s.get("elapsed", "0").split(".")[0])
 
 
-class Changes:
+def song_fields(d):
+    f = d.get("file", "")
+    return (f, d.get("artist", "unknown"), d.get("album", "unknown"),
+            d.get("title", f.split("/")[-1]), d.get("genre", "unknown"),
+            int(d.get("time", 0)))
 
-    def __init__(self):
-        self.changes = []
 
-    def add(self, *args):
-        for s in args:
-            if not s in self.changes:
-                self.changes.append(s)
+# Song metadata, stored once per file in columns (a song is its row)
+class SongStore(object):
 
-    def get(self):
-        c = self.changes
-        self.changes = []
-        return c
+    def __init__(self):
+        self.refs = {}  # file -> ref
+        self.files = []
+        self.artists = []
+        self.albums = []
+        self.titles = []
+        self.genres = []
+        self.times = array("i")
+        self.shared = {}
+        self.hits = {}  # regex -> (len(shared), shared values it matches)
+        self.version = 0  # Bumped whenever a song is added or changed
+        self.packed = None
+        self.masks = {}  # Plain term -> matching rows (with numpy)
+
+    def __len__(self):
+        return len(self.files)
+
+    def _share(self, s):
+        return self.shared.setdefault(s, s)
+
+    def add(self, d):
+        f, artist, album, title, genre, time = song_fields(d)
+        artist, album, genre = (self._share(artist), self._share(album),
+                self._share(genre))
+        ref = self.refs.get(f)
+        if ref == None:
+            ref = self.refs[f] = len(self.files)
+            self.files.append(f)
+            self.artists.append(artist)
+            self.albums.append(album)
+            self.titles.append(title)
+            self.genres.append(genre)
+            self.times.append(time)
+            self.version += 1
+        elif (self.artists[ref], self.albums[ref], self.titles[ref],
+                self.genres[ref], self.times[ref]) != (artist, album, title,
+                genre, time):
+            self.artists[ref] = artist
+            self.albums[ref] = album
+            self.titles[ref] = title
+            self.genres[ref] = genre
+            self.times[ref] = time
+            self.version += 1
+        return ref
+
+    def song(self, d):
+        return Song(self, self.add(d), int(d.get("pos", -1)),
+                int(d.get("id", -1)))
+
+    def _hits(self, r):
+        n, hits = self.hits.get(r, (-1, None))
+        if n != len(self.shared):
+            if len(self.hits) >= 256:
+                self.hits.clear()
+            values = list(self.shared)  # May grow meanwhile
+            hits = set(s for s in values if r.search(s))
+            self.hits[r] = (len(values), hits)
+        return hits
+
+    def _packed(self):
+        return self.packed != None and self.packed[0] == self.version
+
+    def _pack(self):
+        if not self._packed():
+            version, n = self.version, len(self.files)
+            codes = {}
+            artists = numpy.array([codes.setdefault(v, len(codes))
+                for v in self.artists[:n]], numpy.int32)
+            albums = numpy.array([codes.setdefault(v, len(codes))
+                for v in self.albums[:n]], numpy.int32)
+            values = [None] * len(codes)
+            for v, i in codes.iteritems():
+                values[i] = fold(v)
+            titles = numpy.array([fold(v) for v in self.titles[:n]])
+            self.masks = {}
+            self.packed = (version, numpy.array(values), artists, albums,
+                    titles)
+        return self.packed[1:]
+
+    def _mask(self, term):
+        values, artists, albums, titles = self._pack()
+        mask = self.masks.get(term)
+        if mask is None:  # == would compare element-wise
+            if len(self.masks) >= 256:
+                self.masks.clear()
+            t = fold(term)
+            hits = numpy.char.find(values, t) >= 0
+            mask = self.masks[term] = (hits[artists] | hits[albums] |
+                    (numpy.char.find(titles, t) >= 0))
+        return mask
+
+    # Returns None if items were stored after the columns were packed
+    def _scan_plain(self, terms, items):
+        items = list(items)
+        refs = numpy.fromiter((v.ref for v in items), numpy.int32,
+                len(items))
+        keep = numpy.ones(len(items), bool)
+        for t in terms:
+            mask = self._mask(t)
+            if len(refs) and refs.max() >= len(mask):  # Added meanwhile
+                return None
+            keep &= mask[refs]
+        return list(compress(items, keep))
+
+    # With numpy, plain terms are matched over whole columns at once
+    def scan(self, query, items):
+        artists, titles, albums = self.artists, self.titles, self.albums
+        regexes = query.regexes
+        if numpy != None:
+            plain = [t for t in query.terms if is_plain(t)]
+            if plain:
+                items = list(items)
+            if plain and (len(items) >= CHUNK or self._packed()):
+                remaining = self._scan_plain(plain, items)
+                if remaining != None:
+                    items = remaining
+                    regexes = [r for t, r in zip(query.terms,
+                        query.regexes) if not is_plain(t)]
+        if not regexes:
+            return list(items)
+        for r in regexes:
+            search, hits = r.search, self._hits(r)
+            items = [v for v in items if artists[v.ref] in hits or
+                    albums[v.ref] in hits or search(titles[v.ref])]
+        return items
 
 
 class Song(object):
 
-    def __init__(self, d):
-        self.artist = d.get("artist", "unknown")
-        self.album = d.get("album", "unknown")
-        self.file = d.get("file", "")
-        self.title = d.get("title", self.file.split("/")[-1])
-        self.genre = d.get("genre", "unknown")
-        self.time = int(d.get("time", 0))
-        self.pos = int(d.get("pos", -1))
-        self.songid = int(d.get("id", -1))
+    __slots__ = ("store", "ref", "pos", "songid")
+
+    def __init__(self, store, ref, pos=-1, songid=-1):
+        self.store = store
+        self.ref = ref
+        self.pos = pos
+        self.songid = songid
+
+    @property
+    def file(self):
+        return self.store.files[self.ref]
+
+    @property
+    def artist(self):
+        return self.store.artists[self.ref]
+
+    @property
+    def album(self):
+        return self.store.albums[self.ref]
+
+    @property
+    def title(self):
+        return self.store.titles[self.ref]
+
+    @property
+    def genre(self):
+        return self.store.genres[self.ref]
+
+    @property
+    def time(self):
+        return self.store.times[self.ref]
 
     def __eq__(self, o):
         return self.songid == o.songid if o else False
@@ -59,117 +253,360 @@ class Song(object):
         return all(self.matches(r) for r in regexes)
 
 
-class MPDWrapper():
+# Commands in a command list are timed together, when the list ends
+class _Timed(object):
+
+    def __init__(self, client):
+        self.client = client
+        self.listed = None  # Commands of the open command list
+
+    def __getattr__(self, name):
+        func = getattr(self.client, name)
+        if not callable(func):
+            return func
+        if name in ("command_list_begin", "command_list_ok_begin"):
+            return lambda *args: self._begin(func, args)
+        if name == "command_list_end":
+            return lambda *args: self._end(func, args)
+        if self.listed != None:
+            return lambda *args: self._queue(name, func, args)
+        return lambda *args: self._timed("mpd " + name, func, args)
+
+    def __setattr__(self, name, value):
+        if name in ("client", "listed"):
+            object.__setattr__(self, name, value)
+        else:  # E.g. timeout
+            setattr(self.client, name, value)
+
+    def _timed(self, label, func, args):
+        t = time.time()
+        try:
+            return func(*args)
+        finally:
+            metrics.record(label, ms_since(t))
+
+    def _begin(self, func, args):
+        func(*args)
+        self.listed = []
+
+    def _queue(self, name, func, args):
+        if not name in self.listed:
+            self.listed.append(name)
+        try:
+            return func(*args)
+        except:
+            self.listed = None  # The list is abandoned
+            raise
+
+    def _end(self, func, args):
+        listed, self.listed = self.listed or ["command_list_end"], None
+        return self._timed("mpd " + "+".join(listed), func, args)
+
+
+class MPDListener(object):
+
+    def mpd_changed(self, changes):
+        pass
+
+    def mpd_connected(self, connected, message):
+        pass
+
+    def mpd_error(self, message):
+        pass
+
+
+class _IO(Worker):
+
+    def __init__(self, name, wait):
+        super(_IO, self).__init__(name)
+        self.wait_for = wait
+
+    def wait(self):
+        self.wait_for(self.inbox)
 
-    def __init__(self, host, port):
-        self.mpd = MPDClient(use_unicode=True)
-        self.changes = Changes()
+
+# Query methods (status(), ls(), ...) may only run in functions submitted
+class MPDWrapper(Listenable):
+
+    def __init__(self, host, port, events=None, timeout=CONNECT_TIMEOUT):
+        super(MPDWrapper, self).__init__()
+        self.mpd = _Timed(MPDClient(use_unicode=True))
         self.host = host
         self.port = port
+        self.timeout = timeout
+        self.events = events
+        self.io = self.idle_io = None
+        if events != None:
+            self.io = _IO("mpd", self._wait)
+            self.idle_io = _IO("mpd idle", self._idle)
+        self.idler = None  # The idle connection (owned by idle_io)
+        self.watched = None  # The connection idle_io is idling on
         self.connected = False
-        self.in_idle = False
-
-    def auth(self, password):
+        self.password = None
+        self.backoff = Backoff(RECONNECT_FIRST, RECONNECT_LIMIT)
+        self.retry_at = None  # Time of the next connection attempt
+        self.last_used = 0  # Time the command connection was last used
+        self.update_paths = []
+        self.chunked = False  # Whether the database is listed in parts
+        self.songs = SongStore()
+
+    def _post(self, func, *args):
+        if self.events != None:
+            self.events.post(func, *args)
+        else:
+            func(*args)
+
+    def _in_io(self, func, *args):
+        if self.io != None:
+            self.io.submit(func, *args)
+        else:
+            func(*args)
+
+    # done() and failed() are called on the UI thread
+    def submit(self, func, done=None, failed=None):
+        self._in_io(self._run, func, done, failed)
+
+    def _run(self, func, done, failed=None):
+        if not self.connected:
+            if failed != None:
+                self._post(failed)
+            return
+        try:
+            result = func()
+            self.last_used = time.time()
+        except CommandError as e:
+            metrics.count("mpd errors")
+            self._post(self.notify, "mpd_error", str(e))
+            if failed != None:
+                self._post(failed)
+        except (SocketError, ConnectionError) as e:
+            if failed != None:
+                self._post(failed)
+            self._lost(e)
+        else:
+            if done != None:
+                self._post(done, result)
+
+    def _wait(self, inbox):
         if self.connected:
-            try:
-                self.mpd.password(password)
-            except CommandError:
-                return False
-        return True
-
-    def connect(self):
+            unused = time.time() - self.last_used
+            if unused >= KEEPALIVE:
+                self._run(self.mpd.ping, None)
+            else:
+                inbox.wait(KEEPALIVE - unused)
+        elif self.retry_at == None:
+            inbox.wait()
+        else:
+            inbox.wait(max(0, self.retry_at - time.time()))
+            if time.time() >= self.retry_at:
+                self._connect()
+
+    def _idle(self, inbox):
+        client = self.watched
+        if client == None:
+            inbox.wait()
+            return
         try:
-            self.mpd.connect(self.host, self.port)
-            self.connected = True
-        except SocketError:
-            self.connected = False
-        return self.connected
+            client.send_idle()
+            while True:
+                try:
+                    readable = select.select([inbox, client], [], [])[0]
+                    break
+                except select.error as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+            if client in readable:
+                changes = client.fetch_idle()
+            else:
+                changes = self._noidle(client)
+            # An update job that found nothing changed ends without a
+            # database event, so the ends of jobs are watched for too
+            ended = "update" in changes and \
+                    not "updating_db" in client.status()
+        except (SocketError, ConnectionError) as e:
+            self.watched = None
+            self._in_io(self._lost, e, client)
+            return
+        except CommandError as e:  # E.g. not permitted to idle
+            self.watched = None
+            self._post(self.notify, "mpd_error", str(e))
+            return
+        if changes:
+            self._post(self.notify, "mpd_changed", changes)
+        if ended:
+            self._post(self._updated)
+
+    def _noidle(self, client):
+        if not hasattr(client, "send_noidle"):  # Newer python-mpd2
+            return client.noidle()
+        client.send_noidle()
+        return client.fetch_idle()
+
+    def _watch(self, client):
+        self.watched = client
+
+    def _unwatch(self, client):
+        if self.watched is client:
+            self.watched = None
+        _close(client)
+
+    def _lost(self, e, idler=None):
+        if not self.connected or (idler != None and idler is not self.idler):
+            return  # Already handled
+        _log.warning("lost connection: %s", e)
+        metrics.count("mpd connections lost")
+        self._disconnect()
+        self._retry("Lost connection to %s:%s" % (self.host, self.port))
+
+    def _retry(self, message):
+        delay = self.backoff.next()
+        self.retry_at = time.time() + delay
+        self._post(self.notify, "mpd_connected", False,
+                "%s, retrying in %.1f s" % (message, delay))
+
+    def connect(self, password=None):
+        self.password = password
+        self._in_io(self._connect)
+
+    def _connect(self):
+        if self.connected:
+            return
+        self.retry_at = None
+        # The idle connection is set up first, so that no changes made while
+        # connecting are missed
+        clients = [self.mpd]
+        if self.idle_io != None:
+            clients.insert(0, MPDClient(use_unicode=True))
+        authed = True
+        try:
+            for client in clients:
+                _open(client, self.host, self.port, self.timeout)
+                _nodelay(client)
+                if self.password:
+                    try:
+                        client.password(self.password)
+                    except CommandError:
+                        authed = False
+        except (SocketError, ConnectionError) as e:
+            _log.warning("couldn't connect: %s", e)
+            for client in clients:
+                _close(client)
+            self._retry("Couldn't connect to %s:%s" % (self.host, self.port))
+            return
+        self.connected = True
+        self.last_used = time.time()
+        self.backoff.reset()
+        if self.idle_io != None:
+            self.idler = clients[0]
+            self.idle_io.submit(self._watch, self.idler)
+        self._post(self.notify, "mpd_connected", True, "Connected to %s:%s!" %
+                (self.host, self.port))
+        if not authed:
+            self._post(self.notify, "mpd_error", "Couldn't auth!")
 
     def disconnect(self):
+        self._in_io(self._disconnect)
+
+    def _disconnect(self):
+        self.retry_at = None
         if self.connected:
-            self.mpd.disconnect()
             self.connected = False
-
-    def fileno(self):
-        return self.mpd.fileno()
-
-    def get_changes(self):
-        return self.changes.get() if not self.in_idle else []
-
-    def has_changes(self):
-        return len(self.changes.changes)
-
-    def idle(self):
-        if self.connected and not self.in_idle:
-            self.in_idle = True
-            self.mpd.send_idle()
-        return self.in_idle
-
-    def noidle(self, block=False):
-        if self.connected and self.in_idle:
-            self.in_idle = False
-            if not block:
-                self.mpd.send_noidle()
-            self.changes.add(*self.mpd.fetch_idle())
+            _close(self.mpd)
+        if self.idler != None:
+            self.idle_io.submit(self._unwatch, self.idler)
+            self.idler = None
 
     def player(self, cmd, *args):
-        if self.connected:
-            self.changes.add("player")
-            self.noidle()
-            getattr(self.mpd, cmd)(*args)
+        self.submit(lambda: getattr(self.mpd, cmd)(*args))
 
     def option(self, cmd, *args):
-        if self.connected:
-            self.changes.add("options")
-            self.noidle()
-            getattr(self.mpd, cmd)(*args)
+        self.submit(lambda: getattr(self.mpd, cmd)(*args))
 
     def status(self):
-        return self.mpd.status() if self.connected else None
+        return self.mpd.status()
+
+    def stats(self):
+        return self.mpd.stats()
 
     def ls(self, path):
-        return self.mpd.lsinfo(path) if self.connected else []
+        return self.mpd.lsinfo(path)
+
+    def listallinfo(self, path=""):
+        # The whole database may not fit in MPD's output buffer, in which
+        # case it's fetched one top-level directory at a time. Depending on
+        # the version, MPD then either fails the command or closes the
+        # connection (the listing is fetched in parts once reconnected).
+        if path or not self.chunked:
+            try:
+                return self.mpd.listallinfo(path)
+            except CommandError:
+                if path:
+                    raise
+                self.chunked = True
+            except (SocketError, ConnectionError):
+                if not path:
+                    _log.warning("database listing failed, listing it in "
+                            "parts from now on")
+                    self.chunked = True
+                raise
+        entries = []
+        for v in self.mpd.lsinfo(path):
+            entries.append(v)
+            if "directory" in v:
+                entries.extend(self.mpd.listallinfo(v["directory"]))
+        return entries
 
     def plchanges(self, version):
-        return self.mpd.plchanges(version) if self.connected else []
+        return self.mpd.plchanges(version)
+
+    def playlistinfo(self, start, end):
+        return self.mpd.playlistinfo("%i:%i" % (start, end))
 
-    def plchangesposid(self, version):
-        return self.mpd.plchangesposid(version) if self.connected else []
+    def playlistsearch(self, *args):
+        return self.mpd.playlistsearch(*args)
+
+    def currentsong(self):
+        return self.mpd.currentsong()
+
+    def command_list(self, *commands):
+        self.mpd.command_list_ok_begin()
+        for c in commands:
+            getattr(self.mpd, c[0])(*c[1:])
+        return self.mpd.command_list_end()
 
     def add(self, path):
-        if self.connected:
-            self.changes.add("playlist")
-            self.noidle()
-            self.mpd.add(path)
+        self.submit(lambda: self.mpd.add(path))
 
     def add_and_play(self, path):
-        if self.connected:
-            self.changes.add("playlist", "player")
-            self.noidle()
-            self.mpd.playid(self.mpd.addid(path))
+        self.submit(lambda: self.mpd.playid(self.mpd.addid(path)))
 
     def clear(self):
-        if self.connected:
-            self.changes.add("playlist", "player")
-            self.noidle()
-            self.mpd.clear()
+        self.submit(self.mpd.clear)
 
     def delete(self, *poslist):
-        if self.connected:
-            self.changes.add("playlist", "player")
-            self.noidle()
-            self.mpd.command_list_ok_begin()
-            for p in poslist:
-                self.mpd.delete(p)
-            self.mpd.command_list_end()
+        self.submit(lambda: self._delete(poslist))
+
+    def _delete(self, poslist):
+        self.mpd.command_list_ok_begin()
+        for p in poslist:
+            self.mpd.delete(p)
+        self.mpd.command_list_end()
 
     def update(self, path=""):
         if self.connected:
-            self.noidle()
-            self.mpd.update(path)
+            self.update_paths.append(path)
+            self.submit(lambda: self.mpd.update(path))
+
+    # An empty list means that the whole database may have changed
+    def updated_paths(self):
+        paths = self.update_paths
+        self.update_paths = []
+        return [] if "" in paths else paths
 
-    def playlist_song(self, songid):
-        return Song(self.mpd.playlistid(songid)[0])
+    def _updated(self):
+        # MPD isn't updating anymore, whatever is changed from now on wasn't
+        # changed by the updates asked for
+        self.update_paths = []
 
     # Fallback if seekcur command isn't available
     def _seekcur_fallback(self, posstr):
@@ -180,16 +617,12 @@ class MPDWrapper():
         getattr(self.mpd, "seek")(status.get("song", "-1"), time)
 
     def seekcur(self, posstr):
-        if self.connected:
-            self.changes.add("player")
-            self.noidle()
-            try:
-                getattr(self.mpd, "seekcur")(posstr)
-            except CommandError as e:
-                if not unknown_command_error(e, "seekcur"):
-                    raise
-                self._seekcur_fallback(posstr)
+        self.submit(lambda: self._seekcur(posstr))
 
-    def current_song(self):
-        d = self.mpd.currentsong()
-        return Song(d) if d else None
+    def _seekcur(self, posstr):
+        try:
+            getattr(self.mpd, "seekcur")(posstr)
+        except CommandError as e:
+            if not unknown_command_error(e, "seekcur"):
+                raise
+            self._seekcur_fallback(posstr)